@@ -0,0 +1,215 @@
+from dataclasses import dataclass
+from typing import Callable, Optional, TypeAlias
+import networkx as nx
+from pyformlang.cfg import CFG, Epsilon, Production, Terminal, Variable
+from pyformlang.finite_automaton import State
+from pyformlang.rsa import RecursiveAutomaton
+
+from project.graph_index import LabeledGraphIndex, as_labeled_graph_index
+from project.task6 import compact_hellings_based_cfpq, get_normalized_grammar
+from project.task7 import matrix_based_cfpq, ms_matrix_based_cfpq
+from project.task8 import (
+    cfg_to_rsm,
+    compile_rsm,
+    ebnf_to_rsm,
+    ms_tensor_based_cfpq,
+    tensor_based_cfpq,
+)
+from project.task9 import gll_based_cfpq
+
+Grammar: TypeAlias = CFG | str | RecursiveAutomaton
+
+CFG_ENGINES: dict[str, Callable] = {
+    "hellings": compact_hellings_based_cfpq,
+    "matrix": matrix_based_cfpq,
+    "ms_matrix": ms_matrix_based_cfpq,
+}
+RSM_ENGINES: dict[str, Callable] = {
+    "tensor": tensor_based_cfpq,
+    "ms_tensor": ms_tensor_based_cfpq,
+    "gll": gll_based_cfpq,
+}
+ENGINES = [*CFG_ENGINES, *RSM_ENGINES]
+
+# below this many nodes the pure Python engine beats the sparse matrix setup
+SMALL_GRAPH_NODES = 32
+# a query with at most this share of start nodes is answered demand-driven
+FEW_STARTS_RATIO = 0.1
+# GLL walks edges one by one, beyond this average degree ms_matrix wins
+GLL_MAX_AVERAGE_DEGREE = 4.0
+# the tensor engine avoids the normal form when it would blow up the grammar
+NORMAL_FORM_BLOWUP = 4.0
+
+# grammar text is read as a CFG unless told otherwise, "(" or "*" are also
+# ordinary terminals there
+GRAMMAR_FORMATS = ["cfg", "ebnf"]
+
+
+def rsm_to_cfg(rsm: RecursiveAutomaton) -> CFG:
+    productions = set()
+    for nonterminal, box in rsm.boxes.items():
+        dfa = box.dfa
+
+        def state_variable(state: State) -> Variable:
+            return Variable(f"{nonterminal.value}#{state.value}")
+
+        for state in dfa.start_states:
+            productions.add(
+                Production(Variable(nonterminal.value), [state_variable(state)])
+            )
+        for state in dfa.final_states:
+            productions.add(Production(state_variable(state), [Epsilon()]))
+        for state, edges in dfa.to_dict().items():
+            for symbol, to_state in edges.items():
+                if symbol in rsm.boxes:
+                    body_symbol = Variable(symbol.value)
+                else:
+                    body_symbol = Terminal(symbol.value)
+                productions.add(
+                    Production(
+                        state_variable(state), [body_symbol, state_variable(to_state)]
+                    )
+                )
+    return CFG(start_symbol=Variable(rsm.initial_label.value), productions=productions)
+
+
+class GrammarForms:
+    def __init__(self, grammar: Grammar, grammar_format: str = "cfg"):
+        if grammar_format not in GRAMMAR_FORMATS:
+            raise ValueError(
+                f"unknown grammar format {grammar_format!r}, "
+                f"expected one of {GRAMMAR_FORMATS}"
+            )
+        self._cfg: Optional[CFG] = None
+        self._rsm: Optional[RecursiveAutomaton] = None
+        if isinstance(grammar, CFG):
+            self._cfg = grammar
+        elif isinstance(grammar, RecursiveAutomaton):
+            self._rsm = grammar
+        elif grammar_format == "ebnf":
+            self._rsm = ebnf_to_rsm(grammar)
+        else:
+            self._cfg = CFG.from_text(grammar)
+
+    @property
+    def cfg(self) -> CFG:
+        if self._cfg is None:
+            self._cfg = rsm_to_cfg(self._rsm)
+        return self._cfg
+
+    @property
+    def rsm(self) -> RecursiveAutomaton:
+        if self._rsm is None:
+            self._rsm = cfg_to_rsm(self._cfg)
+        return self._rsm
+
+    @property
+    def start_has_productions(self) -> bool:
+        # without them the language is empty and no RSM can be built
+        if self._cfg is not None:
+            return any(
+                production.head == self._cfg.start_symbol
+                for production in self._cfg.productions
+            )
+        return self._rsm.initial_label in self._rsm.boxes
+
+
+@dataclass
+class CFPQDecision:
+    engine: str = ""
+    reason: str = ""
+    node_count: int = 0
+    edge_count: int = 0
+    start_count: int = 0
+    normal_form_productions: int = 0
+    rsm_transitions: int = 0
+
+    @property
+    def average_degree(self) -> float:
+        return self.edge_count / self.node_count if self.node_count else 0.0
+
+    @property
+    def start_ratio(self) -> float:
+        return self.start_count / self.node_count if self.node_count else 0.0
+
+
+def choose_engine(
+    grammar: Grammar | GrammarForms,
+    graph: nx.DiGraph | LabeledGraphIndex,
+    start_nodes: set[int] = None,
+    decision: Optional[CFPQDecision] = None,
+    grammar_format: str = "cfg",
+) -> CFPQDecision:
+    if isinstance(grammar, GrammarForms):
+        forms = grammar
+    else:
+        forms = GrammarForms(grammar, grammar_format)
+    if decision is None:
+        decision = CFPQDecision()
+    graph_index = as_labeled_graph_index(graph)
+    decision.node_count = graph_index.node_count
+    decision.edge_count = graph_index.edge_count
+    decision.start_count = (
+        len(set(start_nodes) & set(graph_index.nodes))
+        if start_nodes
+        else decision.node_count
+    )
+
+    if not forms.start_has_productions:
+        decision.engine = "matrix"
+        decision.reason = "the start symbol has no productions"
+    elif decision.node_count <= SMALL_GRAPH_NODES:
+        decision.engine = "hellings"
+        decision.reason = f"graph has at most {SMALL_GRAPH_NODES} nodes"
+    elif decision.start_ratio <= FEW_STARTS_RATIO:
+        if decision.average_degree <= GLL_MAX_AVERAGE_DEGREE:
+            decision.engine = "gll"
+            decision.reason = "few start nodes on a sparse graph"
+        else:
+            decision.engine = "ms_matrix"
+            decision.reason = "few start nodes on a dense graph"
+    else:
+        # both grammar sizes are only needed to pick between the all-pairs
+        # engines
+        decision.normal_form_productions = len(
+            get_normalized_grammar(forms.cfg).weak_normal_form.productions
+        )
+        rsm_matrices = compile_rsm(forms.rsm).adjacency_matrixes_boolean_decomposition
+        decision.rsm_transitions = sum(matrix.nnz for matrix in rsm_matrices.values())
+        if (
+            decision.normal_form_productions
+            > NORMAL_FORM_BLOWUP * decision.rsm_transitions
+        ):
+            decision.engine = "tensor"
+            decision.reason = "the normal form is much larger than the RSM"
+        else:
+            decision.engine = "matrix"
+            decision.reason = "all-pairs query"
+    return decision
+
+
+def cfpq(
+    grammar: Grammar,
+    graph: nx.DiGraph | LabeledGraphIndex,
+    start_nodes: set[int] = None,
+    final_nodes: set[int] = None,
+    engine: str = "auto",
+    decision: Optional[CFPQDecision] = None,
+    grammar_format: str = "cfg",
+) -> set[tuple[int, int]]:
+    forms = GrammarForms(grammar, grammar_format)
+    # every engine reads the same index, so it is built only once
+    graph = as_labeled_graph_index(graph)
+    if engine == "auto":
+        engine = choose_engine(forms, graph, start_nodes, decision).engine
+    elif decision is not None:
+        decision.engine = engine
+        decision.reason = "requested"
+
+    if engine not in ENGINES:
+        raise ValueError(f"unknown CFPQ engine {engine!r}, expected one of {ENGINES}")
+    if not forms.start_has_productions:
+        return set()
+    if engine in CFG_ENGINES:
+        return CFG_ENGINES[engine](forms.cfg, graph, start_nodes, final_nodes)
+    return RSM_ENGINES[engine](forms.rsm, graph, start_nodes, final_nodes)
@@ -0,0 +1,122 @@
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Any, Iterator, Mapping, Self, Sequence
+import networkx as nx
+import numpy as np
+from scipy.sparse import coo_matrix, csc_matrix, csr_matrix
+
+
+def _read_only(matrix: csr_matrix | csc_matrix) -> csr_matrix | csc_matrix:
+    for array in (matrix.data, matrix.indices, matrix.indptr):
+        array.flags.writeable = False
+    return matrix
+
+
+@dataclass(frozen=True)
+class LabeledGraphIndex:
+    nodes: tuple[Any, ...]
+    index_of_nodes: Mapping[Any, int]
+    csr: Mapping[Any, csr_matrix]
+    csc: Mapping[Any, csc_matrix]
+    # counts and degrees include parallel edges, the matrices do not
+    edge_counts: Mapping[Any, int]
+    out_degrees: np.ndarray
+    in_degrees: np.ndarray
+    self_loop_count: int
+
+    @property
+    def node_count(self) -> int:
+        return len(self.nodes)
+
+    @property
+    def edge_count(self) -> int:
+        return sum(self.edge_counts.values())
+
+    @property
+    def labels(self) -> list[Any]:
+        return list(self.csr)
+
+    def edges(self) -> Iterator[tuple[Any, Any, Any]]:
+        nodes = self.nodes
+        for label, matrix in self.csr.items():
+            rows, columns = matrix.nonzero()
+            for row, column in zip(rows.tolist(), columns.tolist()):
+                yield nodes[row], nodes[column], label
+
+    @classmethod
+    def from_graph(cls, graph: nx.MultiDiGraph) -> Self:
+        nodes = tuple(graph.nodes)
+        index_of_nodes = {node: i for i, node in enumerate(nodes)}
+        coordinates: dict[Any, tuple[list[int], list[int]]] = {}
+        for u, v, label in graph.edges(data="label"):
+            rows, columns = coordinates.setdefault(label, ([], []))
+            rows.append(index_of_nodes[u])
+            columns.append(index_of_nodes[v])
+        return cls.from_label_coordinates(nodes, coordinates)
+
+    @classmethod
+    def from_coo(
+        cls,
+        nodes: Sequence[Any],
+        rows: np.ndarray,
+        columns: np.ndarray,
+        label_ids: np.ndarray,
+        labels: Sequence[Any],
+    ) -> Self:
+        order = np.argsort(label_ids, kind="stable")
+        bounds = np.cumsum(np.bincount(label_ids, minlength=len(labels)))[:-1]
+        coordinates = {
+            label: (rows[edges], columns[edges])
+            for label, edges in zip(labels, np.split(order, bounds))
+            if len(edges) > 0
+        }
+        return cls.from_label_coordinates(tuple(nodes), coordinates)
+
+    @classmethod
+    def from_label_coordinates(
+        cls,
+        nodes: tuple[Any, ...],
+        coordinates: Mapping[Any, tuple[Sequence[int], Sequence[int]]],
+    ) -> Self:
+        n = len(nodes)
+        csr = {}
+        csc = {}
+        edge_counts = {}
+        out_degrees = np.zeros(n, dtype=np.int64)
+        in_degrees = np.zeros(n, dtype=np.int64)
+        self_loop_count = 0
+        for label, (rows, columns) in coordinates.items():
+            rows = np.asarray(rows, dtype=np.int64)
+            columns = np.asarray(columns, dtype=np.int64)
+            edge_counts[label] = len(rows)
+            out_degrees += np.bincount(rows, minlength=n)
+            in_degrees += np.bincount(columns, minlength=n)
+            self_loop_count += int(np.count_nonzero(rows == columns))
+            # parallel edges with the same label collapse into one entry
+            matrix = coo_matrix(
+                (np.ones(len(rows), dtype=np.bool_), (rows, columns)), shape=(n, n)
+            ).tocsr()
+            matrix.sum_duplicates()
+            csr[label] = _read_only(matrix)
+            csc[label] = _read_only(matrix.tocsc())
+        out_degrees.flags.writeable = False
+        in_degrees.flags.writeable = False
+
+        return cls(
+            nodes=nodes,
+            index_of_nodes=MappingProxyType({node: i for i, node in enumerate(nodes)}),
+            csr=MappingProxyType(csr),
+            csc=MappingProxyType(csc),
+            edge_counts=MappingProxyType(edge_counts),
+            out_degrees=out_degrees,
+            in_degrees=in_degrees,
+            self_loop_count=self_loop_count,
+        )
+
+
+def as_labeled_graph_index(
+    graph: nx.MultiDiGraph | LabeledGraphIndex,
+) -> LabeledGraphIndex:
+    if isinstance(graph, LabeledGraphIndex):
+        return graph
+    return LabeledGraphIndex.from_graph(graph)
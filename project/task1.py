@@ -1,8 +1,34 @@
+from collections import OrderedDict
 from dataclasses import dataclass
-from typing import Any, Iterable, Tuple
+import hashlib
+import json
+import os
+from pathlib import Path
+import shutil
+from typing import Any, Iterable, Optional, Tuple
 import cfpq_data
 from cfpq_data.graphs.generators import labeled_two_cycles_graph
 import networkx as nx
+import numpy as np
+from scipy.sparse.csgraph import connected_components
+
+from project.graph_index import LabeledGraphIndex, as_labeled_graph_index
+
+DATASET_CACHE_DIR_ENV = "FORMAL_LANG_DATASET_CACHE_DIR"
+DATASET_OFFLINE_ENV = "FORMAL_LANG_DATASET_OFFLINE"
+DATASET_CACHE_FORMAT_VERSION = 2
+
+
+@dataclass
+class GraphStatistics:
+    label_edge_counts: dict[Any, int]
+    label_densities: dict[Any, float]
+    # histogram[d] is the number of nodes of degree d
+    out_degree_histogram: list[int]
+    in_degree_histogram: list[int]
+    self_loop_count: int
+    scc_count: int
+    largest_scc_size: int
 
 
 @dataclass
@@ -10,21 +36,325 @@ class GraphInfo:
     node_count: int
     edge_count: int
     edge_labels: list[Any]
+    statistics: Optional[GraphStatistics] = None
+
+
+@dataclass
+class LoadedGraph:
+    graph_index: LabeledGraphIndex
+    info: GraphInfo
+
+
+def _parse_node(token: str) -> Any:
+    # cfpq_data reads node ids as integers
+    try:
+        return int(token)
+    except ValueError:
+        return token
+
+
+def _parse_labels(tokens: list[str]) -> list[Any]:
+    # cfpq_data reads the whole label column as integers when it can
+    try:
+        return [int(token) for token in tokens]
+    except ValueError:
+        return tokens
+
+
+@dataclass
+class EdgeArrays:
+    nodes: list[Any]
+    labels: list[Any]
+    rows: np.ndarray
+    columns: np.ndarray
+    label_ids: np.ndarray
 
+    def to_loaded_graph(self) -> LoadedGraph:
+        # the same order as cfpq_data.get_sorted_labels: most used labels
+        # first, ties broken lexicographically
+        label_counts = np.bincount(self.label_ids, minlength=len(self.labels))
+        info = GraphInfo(
+            node_count=len(self.nodes),
+            edge_count=len(self.rows),
+            edge_labels=[
+                label
+                for label, _ in sorted(
+                    zip(self.labels, label_counts.tolist()),
+                    key=lambda pair: (-pair[1], pair[0]),
+                )
+            ],
+        )
+        graph_index = LabeledGraphIndex.from_coo(
+            self.nodes, self.rows, self.columns, self.label_ids, self.labels
+        )
+        return LoadedGraph(graph_index=graph_index, info=info)
 
-def get_graph_info_via_name(name: str) -> GraphInfo:
-    graph_path = cfpq_data.download(name)
-    G = cfpq_data.graph_from_csv(graph_path)
 
-    node_count = len(G)
-    edge_count = G.number_of_edges()
-    edges_labels = cfpq_data.get_sorted_labels(G)
+def read_graph_csv(path: str | Path, chunk_size: int = 2**20) -> EdgeArrays:
+    index_of_tokens: dict[str, int] = {}
+    index_of_labels: dict[str, int] = {}
+    rows_chunks = [np.zeros(0, dtype=np.int64)]
+    columns_chunks = [np.zeros(0, dtype=np.int64)]
+    label_ids_chunks = [np.zeros(0, dtype=np.int64)]
+    with open(path) as file:
+        while lines := file.readlines(chunk_size):
+            rows = []
+            columns = []
+            label_ids = []
+            for line in lines:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                u, v, label = fields[:3]
+                rows.append(index_of_tokens.setdefault(u, len(index_of_tokens)))
+                columns.append(index_of_tokens.setdefault(v, len(index_of_tokens)))
+                label_ids.append(
+                    index_of_labels.setdefault(label, len(index_of_labels))
+                )
+            rows_chunks.append(np.array(rows, dtype=np.int64))
+            columns_chunks.append(np.array(columns, dtype=np.int64))
+            label_ids_chunks.append(np.array(label_ids, dtype=np.int64))
 
-    return GraphInfo(
-        node_count=node_count, edge_count=edge_count, edge_labels=edges_labels
+    # tokens such as "1" and "01" are the same integer label
+    index_of_parsed_labels: dict[Any, int] = {}
+    parsed_label_ids = np.array(
+        [
+            index_of_parsed_labels.setdefault(label, len(index_of_parsed_labels))
+            for label in _parse_labels(list(index_of_labels))
+        ],
+        dtype=np.int64,
+    )
+    return EdgeArrays(
+        nodes=[_parse_node(token) for token in index_of_tokens],
+        labels=list(index_of_parsed_labels),
+        rows=np.concatenate(rows_chunks),
+        columns=np.concatenate(columns_chunks),
+        label_ids=parsed_label_ids[np.concatenate(label_ids_chunks)],
     )
 
 
+def load_graph_csv(path: str | Path, chunk_size: int = 2**20) -> LoadedGraph:
+    return read_graph_csv(path, chunk_size).to_loaded_graph()
+
+
+def _file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(2**20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _graph_csv_of(downloaded: Path) -> Path:
+    # older cfpq_data releases return the CSV itself, newer ones the graph
+    # directory
+    if downloaded.is_dir():
+        return sorted(downloaded.rglob("*.csv"))[0]
+    return downloaded
+
+
+class DatasetCache:
+    # the digests in a manifest are taken from the files as they were stored,
+    # they detect later damage to the cache but do not vouch for the download
+    # itself, cfpq_data publishes no reference digests to check it against
+    def __init__(self, cache_dir: Optional[str | Path] = None, offline: bool = False):
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.offline = offline
+
+    def _graph_dir(self, name: str) -> Path:
+        return self.cache_dir / name
+
+    def _manifest(self, name: str) -> dict[str, Any]:
+        try:
+            with open(self._graph_dir(name) / "manifest.json") as file:
+                manifest = json.load(file)
+        except (OSError, ValueError):
+            return {}
+        if manifest.get("version") != DATASET_CACHE_FORMAT_VERSION:
+            return {}
+        return manifest
+
+    def _store_manifest(self, name: str, manifest: dict[str, Any]):
+        manifest["version"] = DATASET_CACHE_FORMAT_VERSION
+        path = self._graph_dir(name) / "manifest.json"
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "w") as file:
+            json.dump(manifest, file)
+        os.replace(tmp_path, path)
+
+    def _unchanged_since_stored(self, path: Path, stored_sha256: Optional[str]) -> bool:
+        return (
+            stored_sha256 is not None
+            and path.exists()
+            and _file_sha256(path) == stored_sha256
+        )
+
+    def csv_path(self, name: str) -> Path:
+        if self.cache_dir is None:
+            if self.offline:
+                raise FileNotFoundError(
+                    f"graph {name!r} cannot be downloaded offline without a cache"
+                )
+            return _graph_csv_of(Path(cfpq_data.download(name)))
+
+        path = self._graph_dir(name) / "graph.csv"
+        manifest = self._manifest(name)
+        if self._unchanged_since_stored(path, manifest.get("csv_sha256")):
+            return path
+        if self.offline:
+            raise FileNotFoundError(
+                f"graph {name!r} is missing or corrupted in {self.cache_dir}"
+            )
+
+        downloaded = _graph_csv_of(Path(cfpq_data.download(name)))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        shutil.copyfile(downloaded, tmp_path)
+        os.replace(tmp_path, path)
+        # the binary form of an older CSV is stale now
+        self._store_manifest(name, {"csv_sha256": _file_sha256(path)})
+        return path
+
+    def load(self, name: str) -> LoadedGraph:
+        if self.cache_dir is None:
+            return load_graph_csv(self.csv_path(name))
+
+        path = self._graph_dir(name) / f"graph.v{DATASET_CACHE_FORMAT_VERSION}.npz"
+        manifest = self._manifest(name)
+        if self._unchanged_since_stored(path, manifest.get("npz_sha256")):
+            with np.load(path, allow_pickle=False) as arrays:
+                return EdgeArrays(
+                    nodes=[_parse_node(token) for token in arrays["nodes"].tolist()],
+                    labels=_parse_labels(arrays["labels"].tolist()),
+                    rows=arrays["rows"],
+                    columns=arrays["columns"],
+                    label_ids=arrays["label_ids"],
+                ).to_loaded_graph()
+
+        edge_arrays = read_graph_csv(self.csv_path(name))
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp.npz")
+        np.savez(
+            tmp_path,
+            nodes=np.array([str(node) for node in edge_arrays.nodes], dtype=str),
+            labels=np.array(edge_arrays.labels, dtype=str),
+            rows=edge_arrays.rows,
+            columns=edge_arrays.columns,
+            label_ids=edge_arrays.label_ids,
+        )
+        os.replace(tmp_path, path)
+        manifest = self._manifest(name)
+        manifest["npz_sha256"] = _file_sha256(path)
+        self._store_manifest(name, manifest)
+        return edge_arrays.to_loaded_graph()
+
+
+DATASET_CACHE = DatasetCache(
+    cache_dir=os.getenv(DATASET_CACHE_DIR_ENV),
+    offline=os.getenv(DATASET_OFFLINE_ENV, "") not in ("", "0"),
+)
+
+
+def graph_fingerprint(graph_index: LabeledGraphIndex) -> str:
+    digest = hashlib.sha256()
+    digest.update(repr(graph_index.nodes).encode())
+    for label in sorted(graph_index.csr, key=repr):
+        matrix = graph_index.csr[label]
+        digest.update(repr(label).encode())
+        digest.update(matrix.indptr.tobytes())
+        digest.update(matrix.indices.tobytes())
+    # parallel edges only show up in the counts
+    digest.update(repr(sorted(graph_index.edge_counts.items(), key=repr)).encode())
+    digest.update(graph_index.out_degrees.tobytes())
+    digest.update(graph_index.in_degrees.tobytes())
+    digest.update(repr(graph_index.self_loop_count).encode())
+    return digest.hexdigest()
+
+
+def compute_graph_statistics(graph_index: LabeledGraphIndex) -> GraphStatistics:
+    n = graph_index.node_count
+    adjacency = None
+    for matrix in graph_index.csr.values():
+        adjacency = matrix if adjacency is None else adjacency + matrix
+
+    if adjacency is None:
+        scc_count, largest_scc_size = n, min(n, 1)
+    else:
+        scc_count, components = connected_components(
+            adjacency, directed=True, connection="strong"
+        )
+        largest_scc_size = int(np.bincount(components).max())
+
+    return GraphStatistics(
+        label_edge_counts=dict(graph_index.edge_counts),
+        # the share of node pairs joined by the label, parallel edges count once
+        label_densities={
+            label: matrix.nnz / (n * n) for label, matrix in graph_index.csr.items()
+        },
+        out_degree_histogram=np.bincount(graph_index.out_degrees).tolist(),
+        in_degree_histogram=np.bincount(graph_index.in_degrees).tolist(),
+        self_loop_count=graph_index.self_loop_count,
+        scc_count=int(scc_count),
+        largest_scc_size=largest_scc_size,
+    )
+
+
+class GraphStatisticsCache:
+    def __init__(self, maxsize: int = 32):
+        self.maxsize = maxsize
+        self._entries: OrderedDict[str, GraphStatistics] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, graph_index: LabeledGraphIndex) -> GraphStatistics:
+        fingerprint = graph_fingerprint(graph_index)
+        entry = self._entries.get(fingerprint)
+        if entry is not None:
+            self._entries.move_to_end(fingerprint)
+            return entry
+
+        entry = compute_graph_statistics(graph_index)
+        self._entries[fingerprint] = entry
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        self._entries.clear()
+
+
+GRAPH_STATISTICS_CACHE = GraphStatisticsCache()
+
+
+def get_graph_info(
+    graph: nx.MultiDiGraph | LabeledGraphIndex, detailed: bool = False
+) -> GraphInfo:
+    if isinstance(graph, LabeledGraphIndex):
+        info = GraphInfo(
+            node_count=graph.node_count,
+            edge_count=graph.edge_count,
+            edge_labels=sorted(
+                graph.edge_counts, key=lambda label: (-graph.edge_counts[label], label)
+            ),
+        )
+    else:
+        info = GraphInfo(
+            node_count=graph.number_of_nodes(),
+            edge_count=graph.number_of_edges(),
+            edge_labels=cfpq_data.get_sorted_labels(graph),
+        )
+    if detailed:
+        info.statistics = GRAPH_STATISTICS_CACHE.get(as_labeled_graph_index(graph))
+    return info
+
+
+def get_graph_info_via_name(name: str, detailed: bool = False) -> GraphInfo:
+    loaded = DATASET_CACHE.load(name)
+    if detailed:
+        loaded.info.statistics = GRAPH_STATISTICS_CACHE.get(loaded.graph_index)
+    return loaded.info
+
+
 def save_labeled_two_cycles_graph(
     n: int | Iterable[Any],
     m: int | Iterable[Any],
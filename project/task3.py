@@ -12,7 +12,8 @@ from pyformlang.finite_automaton.symbol import Symbol
 from scipy.sparse._csr import csr_matrix
 from scipy.sparse import kron
 
-from project.task2 import graph_to_nfa, regex_to_dfa
+from project.graph_index import LabeledGraphIndex, as_labeled_graph_index
+from project.task2 import regex_to_dfa
 
 Transition: TypeAlias = Any
 
@@ -107,7 +108,7 @@ class AdjacencyMatrixFA:
                     operator.add, adjacency_matrixes[1:], adjacency_matrixes[0]
                 )
             else:
-                transitions: csr_matrix = adjacency_matrixes[0]
+                transitions: csr_matrix = adjacency_matrixes[0].copy()
         else:
             return csr_matrix(np.eye(self.state_count, dtype=np.bool_))
         transitions.setdiag(True)
@@ -128,6 +129,31 @@ class AdjacencyMatrixFA:
                     return False
         return True
 
+    @classmethod
+    def from_graph_index(
+        cls,
+        graph_index: LabeledGraphIndex,
+        start_states: Optional[Iterable] = None,
+        final_states: Optional[Iterable] = None,
+    ) -> Self:
+        inst = cls(None)
+        inst.index_of_states = dict(graph_index.index_of_nodes)
+        inst.start_states = set(
+            state
+            for state in (start_states or graph_index.nodes)
+            if state in graph_index.index_of_nodes
+        )
+        inst.final_states = set(
+            state
+            for state in (final_states or graph_index.nodes)
+            if state in graph_index.index_of_nodes
+        )
+        # the index is shared between queries, the automaton gets its own copies
+        inst.adjacency_matrixes_boolean_decomposition = {
+            label: matrix.copy() for label, matrix in graph_index.csr.items()
+        }
+        return inst
+
     @classmethod
     def intersect_automata(cls, automaton1: Self, automaton2: Self) -> Self:
         inst = cls(None)
@@ -189,12 +215,14 @@ def intersect_automata(
 
 def tensor_based_rpq(
     regex: str,
-    graph: MultiDiGraph,
+    graph: MultiDiGraph | LabeledGraphIndex,
     start_nodes: set[int],
     final_nodes: set[int],
 ) -> set[tuple[int, int]]:
     adj_from_regex = AdjacencyMatrixFA(regex_to_dfa(regex))
-    adj_from_graph = AdjacencyMatrixFA(graph_to_nfa(graph, start_nodes, final_nodes))
+    adj_from_graph = AdjacencyMatrixFA.from_graph_index(
+        as_labeled_graph_index(graph), start_nodes, final_nodes
+    )
     intersected = intersect_automata(adj_from_graph, adj_from_regex)
 
     trans_closure = intersected.transitive_closure()
@@ -5,7 +5,8 @@ from functools import reduce
 from collections import defaultdict
 
 
-from project.task2 import regex_to_dfa, graph_to_nfa
+from project.graph_index import LabeledGraphIndex, as_labeled_graph_index
+from project.task2 import regex_to_dfa
 from project.task3 import AdjacencyMatrixFA
 
 
@@ -26,10 +27,15 @@ def get_init_front(
 
 
 def ms_bfs_based_rpq(
-    regex: str, graph: MultiDiGraph, start_nodes: set[int], final_nodes: set[int]
+    regex: str,
+    graph: MultiDiGraph | LabeledGraphIndex,
+    start_nodes: set[int],
+    final_nodes: set[int],
 ) -> set[tuple[int, int]]:
     adj_regex = AdjacencyMatrixFA(regex_to_dfa(regex))
-    adj_graph = AdjacencyMatrixFA(graph_to_nfa(graph, start_nodes, final_nodes))
+    adj_graph = AdjacencyMatrixFA.from_graph_index(
+        as_labeled_graph_index(graph), start_nodes, final_nodes
+    )
 
     regex_state_count = adj_regex.state_count
 
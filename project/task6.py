@@ -1,15 +1,38 @@
-from pyformlang.cfg import CFG, Production, Variable, Epsilon
+from collections import OrderedDict, deque
+from dataclasses import asdict, dataclass
+import hashlib
+from importlib.metadata import version
+import json
+import os
+from pathlib import Path
+from typing import Any, Iterator, Optional, Self
+from pyformlang.cfg import CFG, Production, Variable, Epsilon, Terminal
 import networkx as nx
 
+from project.graph_index import LabeledGraphIndex, as_labeled_graph_index
 
-def cfg_to_weak_normal_form(cfg: CFG) -> CFG:
+CACHE_DIR_ENV = "FORMAL_LANG_CFG_CACHE_DIR"
+CACHE_FORMAT_VERSION = 3
+# on-disk entries are keyed by the code that normalized them, so a change to
+# this module or to pyformlang never reuses older grammars
+NORMALIZATION_HASH = hashlib.sha256(
+    Path(__file__).read_bytes() + version("pyformlang").encode()
+).hexdigest()[:16]
+
+
+def _normalize(cfg: CFG) -> CFG:
     if len(cfg.productions) == 0:
         return cfg
 
     normal_form_cfg = cfg.to_normal_form()
     nullable = cfg.get_nullable_symbols()
 
-    new_productions = set(normal_form_cfg.productions)
+    # to_normal_form keeps unit productions A -> A, they add no derivations
+    new_productions = {
+        production
+        for production in normal_form_cfg.productions
+        if production.body != [production.head]
+    }
     for var in nullable:
         new_productions.add(Production(Variable(var.value), [Epsilon()]))
 
@@ -18,23 +41,302 @@ def cfg_to_weak_normal_form(cfg: CFG) -> CFG:
     ).remove_useless_symbols()
 
 
+@dataclass
+class GrammarReduction:
+    variables_before: int
+    variables_after: int
+    productions_before: int
+    productions_after: int
+
+    @property
+    def removed_variables(self) -> int:
+        return self.variables_before - self.variables_after
+
+    @property
+    def removed_productions(self) -> int:
+        return self.productions_before - self.productions_after
+
+
+def _rename_variables(cfg: CFG, renaming: dict[Variable, Variable]) -> CFG:
+    productions = set()
+    for production in cfg.productions:
+        head = renaming.get(production.head, production.head)
+        body = [renaming.get(symbol, symbol) for symbol in production.body]
+        if body == [head]:
+            continue
+        productions.add(Production(head, body))
+    return CFG(start_symbol=cfg.start_symbol, productions=productions)
+
+
+def optimize_grammar(cfg: CFG) -> tuple[CFG, GrammarReduction]:
+    variables_before, productions_before = len(cfg.variables), len(cfg.productions)
+    optimized = cfg.remove_useless_symbols()
+    start_symbol = optimized.start_symbol
+
+    def representative(variables: list[Variable]) -> Variable:
+        if start_symbol in variables:
+            return start_symbol
+        return min(variables, key=str)
+
+    while True:
+        bodies_of_vars: dict[Variable, set[tuple]] = {}
+        for production in optimized.productions:
+            body = tuple(
+                symbol for symbol in production.body if not isinstance(symbol, Epsilon)
+            )
+            bodies_of_vars.setdefault(production.head, set()).add(body)
+
+        renaming: dict[Variable, Variable] = {}
+        # A -> B being the only production of A makes A an alias of B, weak
+        # normal forms have no unit productions, so for them only the merging
+        # below applies
+        for var, bodies in bodies_of_vars.items():
+            if var == start_symbol or len(bodies) != 1:
+                continue
+            (body,) = bodies
+            if len(body) == 1 and isinstance(body[0], Variable) and body[0] != var:
+                renaming[var] = body[0]
+
+        if not renaming:
+            vars_of_bodies: dict[frozenset, list[Variable]] = {}
+            for var, bodies in bodies_of_vars.items():
+                vars_of_bodies.setdefault(frozenset(bodies), []).append(var)
+            for variables in vars_of_bodies.values():
+                if len(variables) > 1:
+                    merged_into = representative(variables)
+                    for var in variables:
+                        if var != merged_into:
+                            renaming[var] = merged_into
+
+        if not renaming:
+            break
+        # resolve alias chains so that every variable is renamed at most once
+        for var in renaming:
+            target = renaming[var]
+            seen = {var}
+            while target in renaming and target not in seen:
+                seen.add(target)
+                target = renaming[target]
+            renaming[var] = target
+        renaming = {var: target for var, target in renaming.items() if var != target}
+        if not renaming:
+            break
+        optimized = _rename_variables(optimized, renaming).remove_useless_symbols()
+
+    return optimized, GrammarReduction(
+        variables_before=variables_before,
+        variables_after=len(optimized.variables),
+        productions_before=productions_before,
+        productions_after=len(optimized.productions),
+    )
+
+
+def _symbol_key(symbol: Optional[Variable | Terminal]) -> str:
+    # repr of a symbol drops the type of its value, while Terminal(1) and
+    # Terminal("1") are different symbols
+    if symbol is None:
+        return repr(None)
+    value = symbol.value
+    return repr((type(symbol).__name__, type(value).__name__, repr(value)))
+
+
+def cfg_fingerprint(cfg: CFG) -> str:
+    productions = sorted(
+        f"{_symbol_key(production.head)} -> "
+        f"{' '.join(map(_symbol_key, production.body))}"
+        for production in cfg.productions
+    )
+    canonical = "\n".join([_symbol_key(cfg.start_symbol), *productions])
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+@dataclass
+class ProductionTables:
+    term_productions: dict[Any, set[Variable]]
+    eps_productions: set[Variable]
+    nonterms_productions: dict[tuple[Variable, Variable], set[Variable]]
+
+    @classmethod
+    def from_weak_normal_form(cls, weak_normal_form: CFG) -> Self:
+        tables = cls(
+            term_productions={}, eps_productions=set(), nonterms_productions={}
+        )
+        for production in weak_normal_form.productions:
+            head = production.head
+            body = production.body
+            if len(body) == 1 and isinstance(body[0], Terminal):
+                prods = tables.term_productions.setdefault(body[0].value, set())
+            elif len(body) == 0 or isinstance(body[0], Epsilon):
+                prods = tables.eps_productions
+            else:
+                prods = tables.nonterms_productions.setdefault(
+                    (body[0], body[1]), set()
+                )
+            prods.add(head)
+        return tables
+
+
+@dataclass
+class NormalizedGrammar:
+    weak_normal_form: CFG
+    tables: ProductionTables
+    reduction: GrammarReduction
+
+    def to_json(self) -> Optional[dict[str, Any]]:
+        # only string symbols survive a JSON round trip unchanged
+        def symbol_to_json(symbol) -> Optional[list[str]]:
+            if not isinstance(symbol.value, str):
+                return None
+            if isinstance(symbol, Variable):
+                return ["variable", symbol.value]
+            return ["terminal", symbol.value]
+
+        start_symbol = symbol_to_json(self.weak_normal_form.start_symbol)
+        if start_symbol is None:
+            return None
+        productions = []
+        for production in self.weak_normal_form.productions:
+            body = [
+                symbol for symbol in production.body if not isinstance(symbol, Epsilon)
+            ]
+            encoded = [symbol_to_json(symbol) for symbol in [production.head, *body]]
+            if None in encoded:
+                return None
+            productions.append(encoded)
+        return {
+            "start_symbol": start_symbol,
+            "productions": productions,
+            "reduction": asdict(self.reduction),
+        }
+
+    @classmethod
+    def from_json(cls, data: dict[str, Any]) -> Self:
+        def symbol_from_json(encoded: list[str]) -> Variable | Terminal:
+            kind, value = encoded
+            if not isinstance(value, str):
+                raise ValueError(f"symbol value {value!r} is not a string")
+            if kind == "variable":
+                return Variable(value)
+            if kind == "terminal":
+                return Terminal(value)
+            raise ValueError(f"unknown symbol kind {kind!r}")
+
+        productions = set()
+        for encoded in data["productions"]:
+            head, *body = map(symbol_from_json, encoded)
+            if not isinstance(head, Variable):
+                raise ValueError(f"production head {head!r} is not a variable")
+            productions.add(Production(head, body))
+        weak_normal_form = CFG(
+            start_symbol=symbol_from_json(data["start_symbol"]),
+            productions=productions,
+        )
+        return cls(
+            weak_normal_form=weak_normal_form,
+            tables=ProductionTables.from_weak_normal_form(weak_normal_form),
+            reduction=GrammarReduction(**data["reduction"]),
+        )
+
+
+class WeakNormalFormCache:
+    def __init__(self, maxsize: int = 128, cache_dir: Optional[str | Path] = None):
+        self.maxsize = maxsize
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self._entries: OrderedDict[str, NormalizedGrammar] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _path_of(self, fingerprint: str) -> Path:
+        return (
+            self.cache_dir
+            / f"{fingerprint}.{NORMALIZATION_HASH}.v{CACHE_FORMAT_VERSION}.json"
+        )
+
+    def _load(self, fingerprint: str) -> Optional[NormalizedGrammar]:
+        if self.cache_dir is None:
+            return None
+        # plain data only, the directory may be shared and is not trusted
+        # with anything that runs code on load
+        try:
+            with open(self._path_of(fingerprint)) as file:
+                return NormalizedGrammar.from_json(json.load(file))
+        except (OSError, KeyError, TypeError, ValueError):
+            return None
+
+    def _store(self, fingerprint: str, entry: NormalizedGrammar):
+        if self.cache_dir is None:
+            return
+        data = entry.to_json()
+        if data is None:
+            return
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        path = self._path_of(fingerprint)
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "w") as file:
+            json.dump(data, file)
+        os.replace(tmp_path, path)
+
+    def get(self, cfg: CFG) -> NormalizedGrammar:
+        fingerprint = cfg_fingerprint(cfg)
+        entry = self._entries.get(fingerprint)
+        if entry is not None:
+            self._entries.move_to_end(fingerprint)
+            return entry
+
+        entry = self._load(fingerprint)
+        if entry is None:
+            weak_normal_form, reduction = optimize_grammar(_normalize(cfg))
+            entry = NormalizedGrammar(
+                weak_normal_form=weak_normal_form,
+                tables=ProductionTables.from_weak_normal_form(weak_normal_form),
+                reduction=reduction,
+            )
+            self._store(fingerprint, entry)
+
+        self._entries[fingerprint] = entry
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        self._entries.clear()
+
+
+WEAK_NORMAL_FORM_CACHE = WeakNormalFormCache(cache_dir=os.getenv(CACHE_DIR_ENV))
+
+
+def get_normalized_grammar(cfg: CFG) -> NormalizedGrammar:
+    # the entry is shared by every caller of the cache and must not be mutated
+    return WEAK_NORMAL_FORM_CACHE.get(cfg)
+
+
+def cfg_to_weak_normal_form(cfg: CFG) -> CFG:
+    weak_normal_form = get_normalized_grammar(cfg).weak_normal_form
+    return CFG(
+        start_symbol=weak_normal_form.start_symbol,
+        productions=set(weak_normal_form.productions),
+    )
+
+
 def hellings_based_cfpq(
     cfg: CFG,
-    graph: nx.DiGraph,
+    graph: nx.DiGraph | LabeledGraphIndex,
     start_nodes: set[int] = None,
     final_nodes: set[int] = None,
 ) -> set[tuple[int, int]]:
     weak_normal_form = cfg_to_weak_normal_form(cfg)
+    graph_index = as_labeled_graph_index(graph)
 
     transitions = set()
 
-    for u, v, label in graph.edges(data="label"):
+    for u, v, label in graph_index.edges():
         for production in weak_normal_form.productions:
             if len(production.body) == 1 and production.body[0].value == label:
                 transitions.add((u, production.head, v))
 
     nullable = weak_normal_form.get_nullable_symbols()
-    for node in graph.nodes:
+    for node in graph_index.nodes:
         for label in nullable:
             transitions.add((node, label, node))
 
@@ -59,9 +361,9 @@ def hellings_based_cfpq(
         transitions.update(delta)
 
     if not start_nodes:
-        start_nodes = set(graph.nodes)
+        start_nodes = set(graph_index.nodes)
     if not final_nodes:
-        final_nodes = set(graph.nodes)
+        final_nodes = set(graph_index.nodes)
 
     res = set()
     for u, label, v in transitions:
@@ -70,3 +372,96 @@ def hellings_based_cfpq(
                 res.add((u, v))
 
     return res
+
+
+def _iter_bits(bitset: int) -> Iterator[int]:
+    while bitset:
+        lowest = bitset & -bitset
+        yield lowest.bit_length() - 1
+        bitset ^= lowest
+
+
+def compact_hellings_based_cfpq(
+    cfg: CFG,
+    graph: nx.DiGraph | LabeledGraphIndex,
+    start_nodes: set[int] = None,
+    final_nodes: set[int] = None,
+) -> set[tuple[int, int]]:
+    normalized = get_normalized_grammar(cfg)
+    weak_normal_form = normalized.weak_normal_form
+    tables = normalized.tables
+
+    graph_index = as_labeled_graph_index(graph)
+    nodes = graph_index.nodes
+    index_of_nodes = graph_index.index_of_nodes
+    index_of_vars = {
+        var: idx for idx, var in enumerate(sorted(weak_normal_form.variables, key=str))
+    }
+
+    term_heads = {
+        label: [index_of_vars[head] for head in heads]
+        for label, heads in tables.term_productions.items()
+    }
+    eps_heads = [index_of_vars[head] for head in tables.eps_productions]
+    # A -> B C is indexed both by B (left operand) and by C (right operand)
+    by_left: list[list[tuple[int, int]]] = [[] for _ in index_of_vars]
+    by_right: list[list[tuple[int, int]]] = [[] for _ in index_of_vars]
+    for (left, right), heads in tables.nonterms_productions.items():
+        left, right = index_of_vars[left], index_of_vars[right]
+        for head in heads:
+            head = index_of_vars[head]
+            by_left[left].append((head, right))
+            by_right[right].append((head, left))
+
+    # successors[A][u] has bit v set iff (u, A, v) is derived, predecessors[A][v] is
+    # the transposed row
+    successors = [[0] * len(nodes) for _ in index_of_vars]
+    predecessors = [[0] * len(nodes) for _ in index_of_vars]
+    queue: deque[tuple[int, int, int]] = deque()
+
+    def add(u: int, var: int, v: int):
+        if successors[var][u] >> v & 1:
+            return
+        successors[var][u] |= 1 << v
+        predecessors[var][v] |= 1 << u
+        queue.append((u, var, v))
+
+    for label, matrix in graph_index.csr.items():
+        heads = term_heads.get(label, ())
+        if not heads:
+            continue
+        rows, columns = matrix.nonzero()
+        for u, v in zip(rows.tolist(), columns.tolist()):
+            for head in heads:
+                add(u, head, v)
+    for head in eps_heads:
+        for u in range(len(nodes)):
+            add(u, head, u)
+
+    while queue:
+        u, var, v = queue.popleft()
+        for head, right in by_left[var]:
+            for w in _iter_bits(successors[right][v] & ~successors[head][u]):
+                add(u, head, w)
+        for head, left in by_right[var]:
+            for w in _iter_bits(predecessors[left][u] & ~predecessors[head][v]):
+                add(w, head, v)
+
+    if not start_nodes:
+        start_nodes = set(nodes)
+    if not final_nodes:
+        final_nodes = set(nodes)
+
+    start_symbol = weak_normal_form.start_symbol
+    if start_symbol not in index_of_vars:
+        return set()
+    start_rows = successors[index_of_vars[start_symbol]]
+    final_mask = sum(
+        1 << index_of_nodes[node] for node in final_nodes if node in index_of_nodes
+    )
+    return {
+        (start_node, nodes[v])
+        for start_node in start_nodes
+        if start_node in index_of_nodes
+        for v in _iter_bits(start_rows[index_of_nodes[start_node]] & final_mask)
+    }
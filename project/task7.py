@@ -1,68 +1,311 @@
-import itertools
-from typing import Tuple
+from concurrent.futures import Executor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+import time
+from typing import Any, Iterable, Iterator, Optional
 import numpy as np
-from pyformlang.cfg import CFG, Terminal, Epsilon, Variable
+from pyformlang.cfg import CFG, Variable
 import networkx as nx
+import scipy.sparse as sp
 from scipy.sparse import csr_matrix
 
 
-from project.task6 import cfg_to_weak_normal_form
+from project.graph_index import LabeledGraphIndex, as_labeled_graph_index
+from project.task6 import ProductionTables, get_normalized_grammar
+
+
+def iter_adjacency_matrices(
+    tables: ProductionTables,
+    variables: Iterable[Variable],
+    graph_index: LabeledGraphIndex,
+) -> Iterator[tuple[Variable, csr_matrix]]:
+    n = graph_index.node_count
+    label_matrices_of_vars: dict[Variable, list[csr_matrix]] = {}
+    for label, matrix in graph_index.csr.items():
+        for var in tables.term_productions.get(label, ()):
+            label_matrices_of_vars.setdefault(var, []).append(matrix)
+
+    identity = sp.identity(n, dtype=np.bool_, format="csr")
+    for var in variables:
+        matrix = csr_matrix((n, n), dtype=np.bool_)
+        for label_matrix in label_matrices_of_vars.get(var, ()):
+            matrix = matrix + label_matrix
+        if var in tables.eps_productions:
+            matrix = matrix + identity
+        yield var, matrix
+
+
+def init_adjacency_matrices(
+    tables: ProductionTables,
+    variables: Iterable[Variable],
+    graph_index: LabeledGraphIndex,
+) -> dict[Variable, csr_matrix]:
+    return dict(iter_adjacency_matrices(tables, variables, graph_index))
+
+
+def schedule_productions(
+    nonterms_productions: dict[tuple[Variable, Variable], set[Variable]],
+) -> list[dict[tuple[Variable, Variable], set[Variable]]]:
+    dependencies = nx.DiGraph()
+    for (B, C), heads in nonterms_productions.items():
+        for head in heads:
+            dependencies.add_edge(B, head)
+            dependencies.add_edge(C, head)
+
+    condensation = nx.condensation(dependencies)
+    component_of_vars = condensation.graph["mapping"]
+    order = {
+        component: position
+        for position, component in enumerate(nx.topological_sort(condensation))
+    }
+    # a production is closed together with the component of its head only if
+    # it is recursive there, otherwise it reads finished matrices and is
+    # evaluated once, right after the later of its operands is done
+    steps: list[dict[tuple[Variable, Variable], set[Variable]]] = [
+        {} for _ in range(2 * len(order))
+    ]
+    for (B, C), heads in nonterms_productions.items():
+        for head in heads:
+            component = component_of_vars[head]
+            if component in (component_of_vars[B], component_of_vars[C]):
+                step = 2 * order[component]
+            else:
+                step = 2 * max(order[component_of_vars[B]], order[component_of_vars[C]])
+                step += 1
+            steps[step].setdefault((B, C), set()).add(head)
+    # a body that is also recursive in the component just closed is already
+    # evaluated there, its other heads are fed by the same products
+    for step in range(1, len(steps), 2):
+        for body in list(steps[step]):
+            if body in steps[step - 1]:
+                steps[step - 1][body] |= steps[step].pop(body)
+    return [productions for productions in steps if productions]
+
+
+@dataclass
+class MatrixCFPQStats:
+    round_times: list[float] = field(default_factory=list)
+    products: int = 0
+
+    @property
+    def rounds(self) -> int:
+        return len(self.round_times)
+
+
+def semi_naive_closure(
+    adjacency_matrices: dict[Variable, csr_matrix],
+    nonterms_productions: dict[tuple[Variable, Variable], set[Variable]],
+    executor: Optional[Executor] = None,
+    stats: Optional[MatrixCFPQStats] = None,
+):
+    productions_of_vars: dict[Variable, list[tuple[Variable, Variable]]] = {}
+    for B, C in nonterms_productions:
+        productions_of_vars.setdefault(B, []).append((B, C))
+        if C != B:
+            productions_of_vars.setdefault(C, []).append((B, C))
+
+    # deltas=None stands for the first round, where every fact is new and the
+    # full products are computed once
+    deltas: Optional[dict[Variable, csr_matrix]] = None
+
+    def compute_product(body: tuple[Variable, Variable]) -> csr_matrix:
+        B, C = body
+        if deltas is None:
+            return adjacency_matrices[B] @ adjacency_matrices[C]
+        if B in deltas and C in deltas:
+            return deltas[B] @ adjacency_matrices[C] + adjacency_matrices[B] @ deltas[C]
+        if B in deltas:
+            return deltas[B] @ adjacency_matrices[C]
+        return adjacency_matrices[B] @ deltas[C]
+
+    while True:
+        round_start = time.perf_counter()
+        if deltas is None:
+            bodies = list(nonterms_productions)
+        else:
+            bodies = list(
+                dict.fromkeys(
+                    body for var in deltas for body in productions_of_vars.get(var, ())
+                )
+            )
+        # a product with an empty operand adds nothing
+        bodies = [
+            (B, C)
+            for B, C in bodies
+            if adjacency_matrices[B].nnz > 0 and adjacency_matrices[C].nnz > 0
+        ]
+
+        if executor is None:
+            products = map(compute_product, bodies)
+        else:
+            products = executor.map(compute_product, bodies)
+
+        # merged in the order of bodies, whichever worker finished first
+        candidates: dict[Variable, csr_matrix] = {}
+        for body, product in zip(bodies, products):
+            for head in nonterms_productions[body]:
+                if head in candidates:
+                    candidates[head] = candidates[head] + product
+                else:
+                    candidates[head] = product
+
+        deltas = {}
+        for var, candidate in candidates.items():
+            delta = candidate > adjacency_matrices[var]
+            if delta.nnz > 0:
+                deltas[var] = delta
+        for var, delta in deltas.items():
+            adjacency_matrices[var] = adjacency_matrices[var] + delta
+
+        if stats is not None:
+            stats.products += len(bodies)
+            stats.round_times.append(time.perf_counter() - round_start)
+        if not deltas:
+            return
 
 
 def matrix_based_cfpq(
     cfg: CFG,
-    graph: nx.DiGraph,
+    graph: nx.DiGraph | LabeledGraphIndex,
     start_nodes: set[int] = None,
     final_nodes: set[int] = None,
+    workers: int = 1,
+    stats: Optional[MatrixCFPQStats] = None,
 ) -> set[tuple[int, int]]:
-    weak_normal_form = cfg_to_weak_normal_form(cfg)
-
-    term_productions: dict[Terminal, set[Variable]] = {}
-    eps_productions: set[Variable] = set()
-    nonterms_productions: dict[Tuple[Variable, Variable], set[Variable]] = {}
-
-    for production in weak_normal_form.productions:
-        head = production.head
-        body = production.body
-        if len(body) == 1 and isinstance(body[0], Terminal):
-            prods = term_productions.setdefault(body[0].value, set())
-        elif len(body) == 0 or isinstance(body[0], Epsilon):
-            prods = eps_productions
-        else:
-            prods = nonterms_productions.setdefault((body[0], body[1]), set())
-        prods.add(head)
+    normalized = get_normalized_grammar(cfg)
+    weak_normal_form = normalized.weak_normal_form
+    nonterms_productions = normalized.tables.nonterms_productions
+
+    graph_index = as_labeled_graph_index(graph)
+    adjacency_matrices = init_adjacency_matrices(
+        normalized.tables, weak_normal_form.variables, graph_index
+    )
+
+    executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        for productions in schedule_productions(nonterms_productions):
+            semi_naive_closure(adjacency_matrices, productions, executor, stats)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return extract_pairs(
+        adjacency_matrices[weak_normal_form.start_symbol],
+        graph_index.nodes,
+        graph_index.index_of_nodes,
+        start_nodes,
+        final_nodes,
+    )
+
+
+def _rows_mask(n: int, index_of_nodes: dict[Any, int], nodes: Iterable) -> np.ndarray:
+    mask = np.zeros(n, dtype=np.bool_)
+    mask[[index_of_nodes[node] for node in nodes if node in index_of_nodes]] = True
+    return mask
+
+
+def _select_rows(matrix: csr_matrix, mask: np.ndarray) -> csr_matrix:
+    return sp.diags(mask, dtype=np.bool_, format="csr") @ matrix
+
+
+def extract_pairs(
+    adjacency_matrix: csr_matrix,
+    nodes: list[Any],
+    index_of_nodes: dict[Any, int],
+    start_nodes: Optional[Iterable] = None,
+    final_nodes: Optional[Iterable] = None,
+) -> set[tuple[int, int]]:
+    n = len(nodes)
+    start_mask = _rows_mask(n, index_of_nodes, start_nodes or nodes)
+    final_mask = _rows_mask(n, index_of_nodes, final_nodes or nodes)
+    rows, columns = _select_rows(adjacency_matrix, start_mask).nonzero()
+    keep = final_mask[columns]
+    return {
+        (nodes[row], nodes[column])
+        for row, column in zip(rows[keep].tolist(), columns[keep].tolist())
+    }
 
-    index_of_nodes = {n: i for i, n in enumerate(graph.nodes)}
-    n = len(graph.nodes)
+
+def ms_matrix_based_cfpq(
+    cfg: CFG,
+    graph: nx.DiGraph | LabeledGraphIndex,
+    start_nodes: set[int] = None,
+    final_nodes: set[int] = None,
+) -> set[tuple[int, int]]:
+    normalized = get_normalized_grammar(cfg)
+    weak_normal_form = normalized.weak_normal_form
+    nonterms_productions = normalized.tables.nonterms_productions
+    start_symbol = weak_normal_form.start_symbol
+
+    graph_index = as_labeled_graph_index(graph)
+    nodes = graph_index.nodes
+    index_of_nodes = graph_index.index_of_nodes
+    n = len(nodes)
+    if start_symbol not in weak_normal_form.variables:
+        return set()
+
+    initial_matrices = init_adjacency_matrices(
+        normalized.tables, weak_normal_form.variables, graph_index
+    )
+    # every matrix only holds the rows of its needed mask: the rows some
+    # derivation from the start nodes actually asks for
     adjacency_matrices = {
-        var: csr_matrix((n, n), dtype=np.bool_) for var in weak_normal_form.variables
+        var: csr_matrix((n, n), dtype=np.bool_) for var in initial_matrices
     }
-    for u, v, label in graph.edges(data="label"):
-        if label in term_productions:
-            for terminal in term_productions[label]:
-                adjacency_matrices[terminal][index_of_nodes[u], index_of_nodes[v]] = (
-                    True
-                )
+    needed = {var: np.zeros(n, dtype=np.bool_) for var in initial_matrices}
+    needed[start_symbol] = _rows_mask(n, index_of_nodes, start_nodes or nodes)
+    new_rows = {start_symbol: needed[start_symbol].copy()}
+    deltas: dict[Variable, csr_matrix] = {}
+
+    while new_rows or deltas:
+        candidates: dict[Variable, csr_matrix] = {
+            var: _select_rows(initial_matrices[var], rows)
+            for var, rows in new_rows.items()
+        }
+        for (B, C), heads in nonterms_productions.items():
+            for head in heads:
+                products = []
+                if head in new_rows:
+                    products.append(
+                        _select_rows(adjacency_matrices[B], new_rows[head])
+                        @ adjacency_matrices[C]
+                    )
+                if B in deltas:
+                    products.append(
+                        _select_rows(deltas[B], needed[head]) @ adjacency_matrices[C]
+                    )
+                if C in deltas:
+                    products.append(
+                        _select_rows(adjacency_matrices[B], needed[head]) @ deltas[C]
+                    )
+                for product in products:
+                    if head in candidates:
+                        candidates[head] = candidates[head] + product
+                    else:
+                        candidates[head] = product
+
+        deltas = {}
+        for var, candidate in candidates.items():
+            delta = candidate > adjacency_matrices[var]
+            if delta.nnz > 0:
+                deltas[var] = delta
+                adjacency_matrices[var] = adjacency_matrices[var] + delta
+
+        before = {var: rows.copy() for var, rows in needed.items()}
+        for (B, C), heads in nonterms_productions.items():
+            for head in heads:
+                needed[B] |= needed[head]
+                reached = _select_rows(adjacency_matrices[B], needed[head]).indices
+                needed[C][reached] = True
+        new_rows = {}
+        for var, rows in needed.items():
+            added = rows & ~before[var]
+            if added.any():
+                new_rows[var] = added
 
-    for production in eps_productions:
-        for i in range(n):
-            adjacency_matrices[production][i, i] = True
-
-    queue = set(weak_normal_form.variables)
-    while queue:
-        updated_var = queue.pop()
-        for (B, C), variables in nonterms_productions.items():
-            if not (updated_var == B or updated_var == C):
-                continue
-            new_vars = adjacency_matrices[B] @ adjacency_matrices[C]
-            for variable in variables:
-                before = adjacency_matrices[variable]
-                adjacency_matrices[variable] += new_vars
-                if (before - adjacency_matrices[variable]).count_nonzero() > 0:
-                    queue.add(variable)
-    res = set()
-    adjacency_matrix = adjacency_matrices[weak_normal_form.start_symbol]
-    for start_node, final_node in itertools.product(start_nodes, final_nodes):
-        if adjacency_matrix[index_of_nodes[start_node], index_of_nodes[final_node]]:
-            res.add((start_node, final_node))
-    return res
+    return extract_pairs(
+        adjacency_matrices[start_symbol],
+        nodes,
+        index_of_nodes,
+        start_nodes,
+        final_nodes,
+    )
@@ -1,88 +1,398 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+import hashlib
+from typing import Any, Self
 import networkx as nx
 import numpy as np
 import pyformlang
 import pyformlang.cfg
-from pyformlang.finite_automaton import (
-    NondeterministicFiniteAutomaton,
-)
+from pyformlang.finite_automaton import EpsilonNFA, State, Symbol
 import pyformlang.rsa
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, identity, kron, vstack
 
-from project.task2 import graph_to_nfa
-from project.task3 import AdjacencyMatrixFA, intersect_automata
+from project.graph_index import LabeledGraphIndex, as_labeled_graph_index
+from project.task3 import AdjacencyMatrixFA
+
+
+def extend_transitive_closure(closure: csr_matrix, delta: csr_matrix) -> csr_matrix:
+    # closure is reflexive and transitive, so every round doubles the number
+    # of new edges a path may use
+    while True:
+        updated = closure + closure @ delta @ closure
+        if (updated > closure).nnz == 0:
+            return closure
+        closure = updated
+
+
+@dataclass
+class CompiledRSM:
+    initial_label: Symbol
+    index_of_states: dict[tuple[Symbol, State], int]
+    box_of_states: np.ndarray
+    adjacency_matrixes_boolean_decomposition: dict[Symbol, csr_matrix]
+    start_masks: dict[Symbol, np.ndarray]
+    final_masks: dict[Symbol, np.ndarray]
+    box_labels: list[Any]
+    # per-state tables for engines that walk the RSM one transition at a time:
+    # terminal edges are keyed by the raw label value, nonterminal edges are
+    # (called box index, return state) pairs
+    terminal_edges: list[dict[Any, list[int]]]
+    nonterminal_edges: list[list[tuple[int, int]]]
+    box_start_states: list[list[int]]
+    final_states: int
+
+    @property
+    def state_count(self) -> int:
+        return len(self.index_of_states)
+
+    @property
+    def boxes(self) -> list[Symbol]:
+        return list(self.start_masks)
+
+    @classmethod
+    def from_rsm(cls, rsm: pyformlang.rsa.RecursiveAutomaton) -> Self:
+        boxes = sorted(rsm.boxes, key=str)
+        index_of_states: dict[tuple[Symbol, State], int] = {}
+        for nonterminal in boxes:
+            for state in sorted(rsm.boxes[nonterminal].dfa.states, key=str):
+                index_of_states[(nonterminal, state)] = len(index_of_states)
+        state_count = len(index_of_states)
+
+        box_of_states = np.empty(state_count, dtype=np.int64)
+        start_masks = {}
+        final_masks = {}
+        transitions: dict[Symbol, tuple[list[int], list[int]]] = {}
+        index_of_boxes = {nonterminal: i for i, nonterminal in enumerate(boxes)}
+        terminal_edges: list[dict[Any, list[int]]] = [{} for _ in range(state_count)]
+        nonterminal_edges: list[list[tuple[int, int]]] = [
+            [] for _ in range(state_count)
+        ]
+        box_start_states: list[list[int]] = []
+        final_states = 0
+        for box_index, nonterminal in enumerate(boxes):
+            dfa = rsm.boxes[nonterminal].dfa
+            start_masks[nonterminal] = np.zeros(state_count, dtype=np.bool_)
+            final_masks[nonterminal] = np.zeros(state_count, dtype=np.bool_)
+            for state in dfa.states:
+                box_of_states[index_of_states[(nonterminal, state)]] = box_index
+            box_start_states.append(
+                sorted(
+                    index_of_states[(nonterminal, state)] for state in dfa.start_states
+                )
+            )
+            for state in dfa.start_states:
+                start_masks[nonterminal][index_of_states[(nonterminal, state)]] = True
+            for state in dfa.final_states:
+                final_masks[nonterminal][index_of_states[(nonterminal, state)]] = True
+                final_states |= 1 << index_of_states[(nonterminal, state)]
+            for state, edges in dfa.to_dict().items():
+                from_index = index_of_states[(nonterminal, state)]
+                for symbol, to_state in edges.items():
+                    to_index = index_of_states[(nonterminal, to_state)]
+                    rows, columns = transitions.setdefault(symbol, ([], []))
+                    rows.append(from_index)
+                    columns.append(to_index)
+                    if symbol in index_of_boxes:
+                        nonterminal_edges[from_index].append(
+                            (index_of_boxes[symbol], to_index)
+                        )
+                    else:
+                        terminal_edges[from_index].setdefault(symbol.value, []).append(
+                            to_index
+                        )
+
+        adjacency_matrixes_boolean_decomposition = {
+            symbol: csr_matrix(
+                (np.ones(len(rows), dtype=np.bool_), (rows, columns)),
+                shape=(state_count, state_count),
+            )
+            for symbol, (rows, columns) in transitions.items()
+        }
+        return cls(
+            initial_label=rsm.initial_label,
+            index_of_states=index_of_states,
+            box_of_states=box_of_states,
+            adjacency_matrixes_boolean_decomposition=adjacency_matrixes_boolean_decomposition,
+            start_masks=start_masks,
+            final_masks=final_masks,
+            box_labels=[nonterminal.value for nonterminal in boxes],
+            terminal_edges=terminal_edges,
+            nonterminal_edges=nonterminal_edges,
+            box_start_states=box_start_states,
+            final_states=final_states,
+        )
+
+
+def _object_key(obj: State | Symbol) -> str:
+    value = obj.value
+    return repr((type(value).__name__, repr(value)))
+
+
+def rsm_fingerprint(rsm: pyformlang.rsa.RecursiveAutomaton) -> str:
+    # state names are part of the key, the compiled form indexes states by them
+    lines = [f"initial {_object_key(rsm.initial_label)}"]
+    for nonterminal, box in rsm.boxes.items():
+        dfa = box.dfa
+        label = _object_key(nonterminal)
+        for kind, states in (
+            ("state", dfa.states),
+            ("start", dfa.start_states),
+            ("final", dfa.final_states),
+        ):
+            lines.extend(f"{kind} {label} {_object_key(state)}" for state in states)
+        for state, edges in dfa.to_dict().items():
+            for symbol, to_state in edges.items():
+                lines.append(
+                    f"edge {label} {_object_key(state)} "
+                    f"{_object_key(symbol)} {_object_key(to_state)}"
+                )
+    canonical = "\n".join(sorted(lines))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+COMPILED_RSM_CACHE_SIZE = 128
+_compiled_rsms: OrderedDict[str, CompiledRSM] = OrderedDict()
+
+
+def compile_rsm(rsm: pyformlang.rsa.RecursiveAutomaton) -> CompiledRSM:
+    # keyed by structure, every query from a CFG builds a new RSM object
+    fingerprint = rsm_fingerprint(rsm)
+    compiled = _compiled_rsms.get(fingerprint)
+    if compiled is not None:
+        _compiled_rsms.move_to_end(fingerprint)
+        return compiled
+    compiled = CompiledRSM.from_rsm(rsm)
+    _compiled_rsms[fingerprint] = compiled
+    if len(_compiled_rsms) > COMPILED_RSM_CACHE_SIZE:
+        _compiled_rsms.popitem(last=False)
+    return compiled
 
 
 def tensor_based_cfpq(
     rsa: pyformlang.rsa.RecursiveAutomaton,
-    graph: nx.DiGraph,
+    graph: nx.DiGraph | LabeledGraphIndex,
     start_nodes: set[int] = None,
     final_nodes: set[int] = None,
 ) -> set[tuple[int, int]]:
-    nfa_of_rsm = NondeterministicFiniteAutomaton()
+    compiled_rsm = compile_rsm(rsa)
+    adj_graph = AdjacencyMatrixFA.from_graph_index(
+        as_labeled_graph_index(graph), start_nodes, final_nodes
+    )
+    graph_state_count = adj_graph.state_count
+    graph_matrices = adj_graph.adjacency_matrixes_boolean_decomposition
+    for nonterminal in compiled_rsm.boxes:
+        if nonterminal not in graph_matrices:
+            graph_matrices[nonterminal] = csr_matrix(
+                (graph_state_count, graph_state_count), dtype=np.bool_
+            )
 
-    def concat_nont(nont, s):
-        return nont, s
+    product_state_count = compiled_rsm.state_count * graph_state_count
+    transitions = csr_matrix((product_state_count, product_state_count), dtype=np.bool_)
+    for (
+        symbol,
+        rsm_matrix,
+    ) in compiled_rsm.adjacency_matrixes_boolean_decomposition.items():
+        if symbol in graph_matrices:
+            transitions += kron(rsm_matrix, graph_matrices[symbol], format="csr")
+    transitive_closure = extend_transitive_closure(
+        identity(product_state_count, dtype=np.bool_, format="csr"),
+        transitions.astype(np.bool_),
+    )
+    # only pairs that became reachable since the previous iteration can
+    # produce new nonterminal edges
+    fresh_pairs = transitive_closure
 
-    for nont, box in rsa.boxes.items():
-        dfa = box.dfa
+    graph_indexes = np.arange(graph_state_count)
+    # product indexes of (box start, any vertex) and (box final, any vertex)
+    start_rows = {
+        nonterminal: (
+            np.flatnonzero(mask)[:, None] * graph_state_count + graph_indexes
+        ).ravel()
+        for nonterminal, mask in compiled_rsm.start_masks.items()
+    }
+    final_columns = {
+        nonterminal: (
+            np.flatnonzero(mask)[:, None] * graph_state_count + graph_indexes
+        ).ravel()
+        for nonterminal, mask in compiled_rsm.final_masks.items()
+    }
 
-        for s in dfa.final_states | dfa.start_states:
-            if s in dfa.final_states:
-                nfa_of_rsm.add_final_state(concat_nont(nont, s))
-            if s in dfa.start_states:
-                nfa_of_rsm.add_start_state(concat_nont(nont, s))
+    while True:
+        delta = csr_matrix(transitive_closure.shape, dtype=np.bool_)
+        discovered = False
+        for nonterminal in compiled_rsm.boxes:
+            rows = start_rows[nonterminal]
+            columns = final_columns[nonterminal]
+            found_rows, found_columns = fresh_pairs[rows][:, columns].nonzero()
+            new_graph_edges = csr_matrix(
+                (
+                    np.ones(len(found_rows), dtype=np.bool_),
+                    (
+                        rows[found_rows] % graph_state_count,
+                        columns[found_columns] % graph_state_count,
+                    ),
+                ),
+                shape=(graph_state_count, graph_state_count),
+            )
+            new_graph_edges = new_graph_edges > graph_matrices[nonterminal]
+            if new_graph_edges.nnz == 0:
+                continue
 
-        for u, v, label in dfa.to_networkx().edges(data="label"):
-            nfa_of_rsm.add_transition(concat_nont(nont, u), label, concat_nont(nont, v))
+            discovered = True
+            graph_matrices[nonterminal] += new_graph_edges
+            if nonterminal in compiled_rsm.adjacency_matrixes_boolean_decomposition:
+                delta += kron(
+                    compiled_rsm.adjacency_matrixes_boolean_decomposition[nonterminal],
+                    new_graph_edges,
+                    format="csr",
+                ).astype(np.bool_)
+        if not discovered:
+            break
 
-    adj_rsa = AdjacencyMatrixFA(nfa_of_rsm)
-    adj_graph = AdjacencyMatrixFA(graph_to_nfa(graph, start_nodes, final_nodes))
+        updated_closure = extend_transitive_closure(transitive_closure, delta)
+        fresh_pairs = updated_closure > transitive_closure
+        transitive_closure = updated_closure
 
-    for nont in rsa.boxes:
-        for adj in (adj_graph, adj_rsa):
-            if nont not in adj.adjacency_matrixes_boolean_decomposition:
-                adj.adjacency_matrixes_boolean_decomposition[nont] = csr_matrix(
-                    (adj.state_count, adj.state_count), dtype=np.bool_
-                )
+    res = set()
+    for n in adj_graph.start_states:
+        for m in adj_graph.final_states:
+            if graph_matrices[compiled_rsm.initial_label][
+                adj_graph.index_of_states[n], adj_graph.index_of_states[m]
+            ]:
+                res.add((n, m))
+    return res
 
-    prev_nonzero_count = 0
-    new_nonzero_count = None
-
-    while prev_nonzero_count != new_nonzero_count:
-        prev_nonzero_count = new_nonzero_count
-        intersection = intersect_automata(adj_rsa, adj_graph)
-        transitive_closure = intersection.transitive_closure()
-        for row, column in zip(*transitive_closure.nonzero()):
-            row_state = intersection.state_of_indexes[row]
-            column_state = intersection.state_of_indexes[column]
-            try:
-                (row_symbol, row_rsm_state), row_graph_state = row_state
-                (column_symbol, column_rsm_state), column_graph_state = column_state
-            except ValueError:
-                continue
-            if (
-                row_symbol == column_symbol
-                and row_rsm_state in rsa.boxes[row_symbol].dfa.start_states
-                and column_rsm_state in rsa.boxes[row_symbol].dfa.final_states
-            ):
-                row_graph_index = adj_graph.index_of_states[row_graph_state]
-                column_graph_index = adj_graph.index_of_states[column_graph_state]
-
-                adj_graph.adjacency_matrixes_boolean_decomposition[row_symbol][
-                    row_graph_index, column_graph_index
-                ] = True
-
-        new_nonzero_count = sum(
-            adj_graph.adjacency_matrixes_boolean_decomposition[
-                nonterminal
-            ].count_nonzero()
-            for nonterminal in adj_graph.adjacency_matrixes_boolean_decomposition
+
+def ms_tensor_based_cfpq(
+    rsa: pyformlang.rsa.RecursiveAutomaton,
+    graph: nx.DiGraph | LabeledGraphIndex,
+    start_nodes: set[int] = None,
+    final_nodes: set[int] = None,
+) -> set[tuple[int, int]]:
+    compiled_rsm = compile_rsm(rsa)
+    rsm_matrices = compiled_rsm.adjacency_matrixes_boolean_decomposition
+    adj_graph = AdjacencyMatrixFA.from_graph_index(
+        as_labeled_graph_index(graph), start_nodes, final_nodes
+    )
+    graph_state_count = adj_graph.state_count
+    graph_matrices = adj_graph.adjacency_matrixes_boolean_decomposition
+    for nonterminal in compiled_rsm.boxes:
+        if nonterminal not in graph_matrices:
+            graph_matrices[nonterminal] = csr_matrix(
+                (graph_state_count, graph_state_count), dtype=np.bool_
+            )
+
+    product_state_count = compiled_rsm.state_count * graph_state_count
+    transitions = csr_matrix((product_state_count, product_state_count), dtype=np.bool_)
+    for symbol, rsm_matrix in rsm_matrices.items():
+        if symbol in graph_matrices:
+            transitions += kron(rsm_matrix, graph_matrices[symbol], format="csr")
+    transitions = transitions.astype(np.bool_)
+
+    # RSM states with an outgoing transition that calls the box
+    callers = {
+        nonterminal: np.asarray(rsm_matrices[nonterminal].sum(axis=1)).ravel() > 0
+        for nonterminal in compiled_rsm.boxes
+        if nonterminal in rsm_matrices
+    }
+    final_columns = {
+        nonterminal: (
+            np.flatnonzero(mask)[:, None] * graph_state_count
+            + np.arange(graph_state_count)
+        ).ravel()
+        for nonterminal, mask in compiled_rsm.final_masks.items()
+    }
+
+    # every row of visited is one (box start state, calling vertex) source and
+    # holds the product states reachable from it
+    seeds: list[int] = []
+    seed_boxes: list[Symbol] = []
+    visited = csr_matrix((0, product_state_count), dtype=np.bool_)
+    calls = {
+        nonterminal: np.zeros(graph_state_count, dtype=np.bool_)
+        for nonterminal in compiled_rsm.boxes
+    }
+    new_calls = {compiled_rsm.initial_label: np.zeros(graph_state_count, np.bool_)}
+    for node in adj_graph.start_states:
+        new_calls[compiled_rsm.initial_label][adj_graph.index_of_states[node]] = True
+    delta_transitions = None
+
+    while True:
+        new_seeds = []
+        for nonterminal, vertices in new_calls.items():
+            calls[nonterminal] |= vertices
+            for rsm_state in np.flatnonzero(compiled_rsm.start_masks[nonterminal]):
+                for vertex in np.flatnonzero(vertices):
+                    new_seeds.append(rsm_state * graph_state_count + vertex)
+                    seed_boxes.append(nonterminal)
+        seeds.extend(new_seeds)
+        seeds_front = csr_matrix(
+            (
+                np.ones(len(new_seeds), dtype=np.bool_),
+                (np.arange(len(new_seeds)), new_seeds),
+            ),
+            shape=(len(new_seeds), product_state_count),
         )
+        if delta_transitions is None:
+            old_front = csr_matrix(visited.shape, dtype=np.bool_)
+        else:
+            old_front = (visited @ delta_transitions) > visited
+        visited = vstack([visited, seeds_front], format="csr")
+        front = vstack([old_front, seeds_front], format="csr")
+        visited = visited + front
+        while front.nnz > 0:
+            front = (front @ transitions) > visited
+            visited = visited + front
+
+        seed_rows = np.array(seeds, dtype=np.int64)
+        seed_boxes_array = np.array(seed_boxes, dtype=object)
+        delta_transitions = csr_matrix(transitions.shape, dtype=np.bool_)
+        discovered = False
+        for nonterminal in compiled_rsm.boxes:
+            rows = np.flatnonzero(seed_boxes_array == nonterminal)
+            if len(rows) == 0:
+                continue
+            columns = final_columns[nonterminal]
+            found_rows, found_columns = visited[rows][:, columns].nonzero()
+            new_graph_edges = csr_matrix(
+                (
+                    np.ones(len(found_rows), dtype=np.bool_),
+                    (
+                        seed_rows[rows[found_rows]] % graph_state_count,
+                        columns[found_columns] % graph_state_count,
+                    ),
+                ),
+                shape=(graph_state_count, graph_state_count),
+            )
+            new_graph_edges = new_graph_edges > graph_matrices[nonterminal]
+            if new_graph_edges.nnz == 0:
+                continue
+            discovered = True
+            graph_matrices[nonterminal] += new_graph_edges
+            if nonterminal in rsm_matrices:
+                delta_transitions += kron(
+                    rsm_matrices[nonterminal], new_graph_edges, format="csr"
+                ).astype(np.bool_)
+        transitions = transitions + delta_transitions
+
+        reached = np.unique(visited.indices)
+        reached_rsm_states = reached // graph_state_count
+        reached_vertices = reached % graph_state_count
+        new_calls = {}
+        for nonterminal, rsm_states in callers.items():
+            vertices = np.zeros(graph_state_count, dtype=np.bool_)
+            vertices[reached_vertices[rsm_states[reached_rsm_states]]] = True
+            vertices &= ~calls[nonterminal]
+            if vertices.any():
+                new_calls[nonterminal] = vertices
+
+        if not discovered and not new_calls:
+            break
 
     res = set()
     for n in adj_graph.start_states:
         for m in adj_graph.final_states:
-            if adj_graph.adjacency_matrixes_boolean_decomposition[rsa.initial_label][
+            if graph_matrices[compiled_rsm.initial_label][
                 adj_graph.index_of_states[n], adj_graph.index_of_states[m]
             ]:
                 res.add((n, m))
@@ -90,7 +400,29 @@ def tensor_based_cfpq(
 
 
 def cfg_to_rsm(cfg: pyformlang.cfg.CFG) -> pyformlang.rsa.RecursiveAutomaton:
-    return ebnf_to_rsm(cfg.to_text())
+    # boxes are built from the productions, going through the text form would
+    # read terminals such as "(" or "*" as regex operators
+    enfas: dict[pyformlang.cfg.Variable, EpsilonNFA] = {}
+    for production in cfg.productions:
+        enfa = enfas.setdefault(production.head, EpsilonNFA())
+        state = State(0)
+        enfa.add_start_state(state)
+        for symbol in production.body:
+            if isinstance(symbol, pyformlang.cfg.Epsilon):
+                continue
+            next_state = State(len(enfa.states))
+            enfa.add_transition(state, Symbol(symbol.value), next_state)
+            state = next_state
+        enfa.add_final_state(state)
+
+    return pyformlang.rsa.RecursiveAutomaton(
+        {Symbol(head.value) for head in enfas},
+        Symbol(cfg.start_symbol.value),
+        {
+            pyformlang.rsa.Box(enfa.minimize(), Symbol(head.value))
+            for head, enfa in enfas.items()
+        },
+    )
 
 
 def ebnf_to_rsm(ebnf: str) -> pyformlang.rsa.RecursiveAutomaton:
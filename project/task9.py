@@ -1,162 +1,476 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
-from typing import Any, Iterable, Set, Tuple
+import heapq
+import time
+from typing import Any, Iterator, Optional, Set, TypeAlias
 
 from pyformlang.rsa import RecursiveAutomaton
-from pyformlang.finite_automaton import State, Symbol
 import networkx as nx
-
-
-def get_graph_node_edges(g: nx.MultiDiGraph, from_nd):
-    edges = {}
-    for _, to_nd, lbl in g.edges(from_nd, data="label"):
-        edges.setdefault(lbl, set()).add(to_nd)
-    return edges
+import numpy as np
+
+from project.graph_index import LabeledGraphIndex, as_labeled_graph_index
+from project.task8 import CompiledRSM, compile_rsm
+
+GraphIndex: TypeAlias = list[dict[Any, list[int]]]
+
+
+def get_graph_index(graph_index: LabeledGraphIndex) -> GraphIndex:
+    index: GraphIndex = [{} for _ in range(graph_index.node_count)]
+    for lbl, matrix in graph_index.csr.items():
+        indptr = matrix.indptr.tolist()
+        to_nds = matrix.indices.tolist()
+        for from_nd in np.flatnonzero(np.diff(matrix.indptr)).tolist():
+            index[from_nd][lbl] = to_nds[indptr[from_nd] : indptr[from_nd + 1]]
+    return index
+
+
+class GSS:
+    def __init__(self, node_count: int):
+        self.node_count = node_count
+        self.index_of_vertices: dict[int, int] = {}
+        self.graph_sts: list[int] = []
+        # outgoing edges of each vertex grouped by the RSM state to return to
+        self.edges: list[dict[int, set[int]]] = []
+        self.pop_sets: list[set[int]] = []
+
+    def get_or_add_vertex(self, rsm_st: int, graph_st: int) -> tuple[int, bool]:
+        key = rsm_st * self.node_count + graph_st
+        vertex = self.index_of_vertices.get(key)
+        if vertex is not None:
+            return vertex, False
+        vertex = len(self.graph_sts)
+        self.index_of_vertices[key] = vertex
+        self.graph_sts.append(graph_st)
+        self.edges.append({})
+        self.pop_sets.append(set())
+        return vertex, True
+
+    def add_edge(self, from_v: int, rsm_st: int, to_v: int) -> bool:
+        targets = self.edges[from_v].setdefault(rsm_st, set())
+        if to_v in targets:
+            return False
+        targets.add(to_v)
+        return True
+
+    def add_pop(self, vertex: int, graph_st: int) -> bool:
+        pop_set = self.pop_sets[vertex]
+        if graph_st in pop_set:
+            return False
+        pop_set.add(graph_st)
+        return True
 
 
 @dataclass
-class RSMSt:
-    nonterm: Symbol
-    st: State
-
-    def __hash__(self):
-        return hash((self.nonterm, self.st))
-
-
-def get_rsm_st_edges(
-    rsm: RecursiveAutomaton, from_st: RSMSt
-) -> dict[Symbol, Set[RSMSt]]:
-    nonterm = from_st.nonterm
-    edges = {}
-    if rsm.get_box(nonterm) is None:
-        return {}
-
-    nonterm_edges = rsm.get_box(nonterm).dfa.to_dict()
-    if from_st.st in nonterm_edges.keys():
-        for lbl, to_st in nonterm_edges[from_st.st].items():
-            if not isinstance(to_st, Iterable):
-                edges.setdefault(lbl, set()).add(RSMSt(nonterm, to_st))
+class GLLStats:
+    descriptors: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def descriptors_per_second(self) -> float:
+        return self.descriptors / self.elapsed if self.elapsed > 0 else 0.0
+
+
+# a packed node (prev_rsm_st, mid_graph_st, lbl, box) says that an RSM state
+# was reached from prev_rsm_st by a graph edge mid -lbl-> right, or by a call of
+# box that derives mid..right when box is not None
+PackedNode: TypeAlias = tuple[int, int, Any, Optional[int]]
+GraphPath: TypeAlias = list[tuple[Any, Any, Any]]
+
+
+class SPPF:
+    def __init__(self):
+        self.reset(None)
+        self.nodes: list[Any] = []
+
+    def reset(self, rsm: Optional[CompiledRSM]):
+        self.rsm = rsm
+        # (rsm_st, left, right): the state is reachable in a box call that
+        # started at graph node left and has read the graph up to right
+        self.packed: dict[tuple[int, int, int], set[PackedNode]] = {}
+        # (box, left, right): final states through which the box derives
+        # left..right
+        self.completions: dict[tuple[int, int, int], set[int]] = {}
+        # (callee gss_v, return rsm_st, caller gss_v): states that made the call
+        self.callers: dict[tuple[int, int, int], set[int]] = {}
+        # cheapest derivations of the nodes that path queries have reached
+        self._values: dict[tuple, tuple[int, int]] = {}
+        self._best_rules: dict[tuple, tuple] = {}
+
+    def add_packed(self, rsm_st: int, left: int, right: int, packed: PackedNode):
+        self.packed.setdefault((rsm_st, left, right), set()).add(packed)
+
+    def add_completion(self, box: int, left: int, right: int, final_st: int):
+        self.completions.setdefault((box, left, right), set()).add(final_st)
+
+    def add_caller(self, callee_v: int, rsm_st: int, caller_v: int, from_st: int):
+        self.callers.setdefault((callee_v, rsm_st, caller_v), set()).add(from_st)
+
+    def path(self, start: Any, final: Any) -> Optional[GraphPath]:
+        if self.rsm is None:
+            return None
+        index_of_nodes = {node: i for i, node in enumerate(self.nodes)}
+        if start not in index_of_nodes or final not in index_of_nodes:
+            return None
+        box = self.rsm.boxes.index(self.rsm.initial_label)
+        target = (True, box, index_of_nodes[start], index_of_nodes[final])
+        if target not in self._best_rules:
+            self._choose_derivations(target)
+        if target not in self._best_rules:
+            return None
+
+        res = []
+        # graph edges are pushed as lists to tell them apart from nodes
+        stack: list = [target]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, list):
+                res.append(tuple(item))
                 continue
-
-            for to_state in to_st:
-                edges.setdefault(lbl, set()).add(RSMSt(nonterm, to_state))
-
-    return edges
-
-
-@dataclass
-class GSSV:
-    rsm_st: RSMSt
-    graph_st: int
-
-    def __hash__(self):
-        return hash((self.rsm_st, self.graph_st))
-
-
-@dataclass
-class Config:
-    rsm_st: RSMSt
-    graph_st: int
-    gss_v: GSSV
-
-    def __hash__(self):
-        return hash((self.rsm_st, self.graph_st, self.gss_v))
-
-
-def get_new_configs(
-    conf: Config,
-    gss: nx.MultiDiGraph,
-    graph: nx.DiGraph,
-    rsm: RecursiveAutomaton,
-    init_gss_v: GSSV,
-) -> Tuple[Set[Config], Set[Tuple[int, int]]]:
-    new_configs = set()
-    graph_edges: dict[Any, Set[Any]] = get_graph_node_edges(
-        nx.MultiDiGraph(graph), conf.graph_st
-    )
-    rsm_edges: dict[Symbol, Set[RSMSt]] = get_rsm_st_edges(rsm, conf.rsm_st)
-
-    labels = set(graph_edges.keys()) & set(rsm_edges.keys())
-    for lbl in labels:
-        for rsm_st in rsm_edges[lbl]:
-            for graph_st in graph_edges[lbl]:
-                new_configs.add(Config(rsm_st, graph_st, conf.gss_v))
-
-    POP_SET = "pop_set"
-    for rsm_lbl in rsm_edges.keys():
-        if rsm_lbl in rsm.labels:
-            for rsm_start_st in rsm.get_box(rsm_lbl).start_state:
-                new_rsm_st = RSMSt(rsm_lbl, rsm_start_st)
-                new_gss_v = GSSV(new_rsm_st, conf.graph_st)
-
-                if new_gss_v in gss.nodes and gss.nodes[new_gss_v][POP_SET]:
-                    for graph_st in gss.nodes[new_gss_v][POP_SET]:
-                        for rsm_st in rsm_edges[rsm_lbl]:
-                            gss.add_edge(new_gss_v, conf.gss_v, label=rsm_st)
-                            new_configs.add(Config(rsm_st, graph_st, conf.gss_v))
-                    continue
-
-                for rsm_st in rsm_edges[rsm_lbl]:
-                    gss.add_node(new_gss_v, pop_set=None)
-                    gss.add_edge(new_gss_v, conf.gss_v, label=rsm_st)
-
-                new_configs.add(Config(new_rsm_st, conf.graph_st, new_gss_v))
-
+            _, deps, _, edge = self._best_rules[item]
+            if edge is not None:
+                stack.append(edge)
+            stack.extend(reversed(deps))
+        return res
+
+    def _choose_derivations(self, target: tuple):
+        rules = self._collect_rules(target)
+        # Knuth's generalization of Dijkstra: a derivation is ranked by its
+        # path length and then by its height, so the chosen derivation of a
+        # node only uses strictly smaller ones and never loops
+        values = self._values
+        dependants: dict[tuple, list[int]] = {}
+        remaining = []
+        heap = []
+
+        def push_rule(i: int):
+            _, deps, (length, height), _ = rules[i]
+            for dep in deps:
+                length += values[dep][0]
+                height += values[dep][1]
+            heapq.heappush(heap, ((length, height), i))
+
+        for i, (_, deps, _, _) in enumerate(rules):
+            pending = [dep for dep in deps if dep not in values]
+            remaining.append(len(pending))
+            for dep in pending:
+                dependants.setdefault(dep, []).append(i)
+            if not pending:
+                push_rule(i)
+        while heap:
+            value, i = heapq.heappop(heap)
+            node = rules[i][0]
+            if node in values:
+                continue
+            values[node] = value
+            self._best_rules[node] = rules[i]
+            for j in dependants.get(node, ()):
+                remaining[j] -= 1
+                if remaining[j] == 0:
+                    push_rule(j)
+
+    def _collect_rules(self, target: tuple) -> list[tuple]:
+        # nodes are (True, box, left, right) or (False, rsm_st, left, right),
+        # a rule is (node, dependencies, (length, height), graph edge); nodes
+        # solved by earlier queries are not expanded again
+        rules = []
+        visited = {target}
+        stack = [target]
+        while stack:
+            node = stack.pop()
+            is_box, st, left, right = node
+            deps_list = []
+            if is_box:
+                for final_st in self.completions.get((st, left, right), ()):
+                    deps_list.append(((False, final_st, left, right),))
+                    rules.append((node, deps_list[-1], (0, 1), None))
+            else:
+                box = int(self.rsm.box_of_states[st])
+                if left == right and st in self.rsm.box_start_states[box]:
+                    rules.append((node, (), (0, 0), None))
+                for prev_st, mid, lbl, called_box in self.packed.get(node[1:], ()):
+                    prefix = (False, prev_st, left, mid)
+                    if called_box is None:
+                        edge = [self.nodes[mid], lbl, self.nodes[right]]
+                        deps_list.append((prefix,))
+                        rules.append((node, deps_list[-1], (1, 1), edge))
+                    else:
+                        deps_list.append((prefix, (True, called_box, mid, right)))
+                        rules.append((node, deps_list[-1], (0, 1), None))
+            for deps in deps_list:
+                for dep in deps:
+                    if dep not in visited and dep not in self._values:
+                        visited.add(dep)
+                        stack.append(dep)
+        return rules
+
+
+class GLLState:
+    def __init__(
+        self,
+        rsm: CompiledRSM,
+        graph_index: GraphIndex,
+        sppf: Optional[SPPF] = None,
+    ):
+        self.rsm = rsm
+        self.graph_index = graph_index
+        self.sppf = sppf
+        if sppf is not None:
+            sppf.reset(rsm)
+        self.gss = GSS(len(graph_index))
+        self.init_gss_v, _ = self.gss.get_or_add_vertex(-1, 0)
+        self.initial_box = rsm.boxes.index(rsm.initial_label)
+        # a descriptor (rsm_st, graph_st, gss_v) is packed into a single int
+        self.seen: set[int] = set()
+        self.queue: deque[int] = deque()
+        self.results: dict[int, set[int]] = {}
+
+    def push(self, rsm_st: int, graph_st: int, gss_v: int):
+        descriptor = (
+            gss_v * len(self.graph_index) + graph_st
+        ) * self.rsm.state_count + rsm_st
+        if descriptor not in self.seen:
+            self.seen.add(descriptor)
+            self.queue.append(descriptor)
+
+    def _add_result(self, start_st: int, final_st: int) -> bool:
+        finals = self.results.setdefault(start_st, set())
+        if final_st in finals:
+            return False
+        finals.add(final_st)
+        return True
+
+    def add_source(self, start_st: int) -> list[int]:
+        # the source may already have been called from another query, its
+        # known pops are answers right away
+        res = []
+        for rsm_st in self.rsm.box_start_states[self.initial_box]:
+            gss_v, created = self.gss.get_or_add_vertex(rsm_st, start_st)
+            if not self.gss.add_edge(gss_v, rsm_st, self.init_gss_v):
+                continue
+            if created:
+                self.push(rsm_st, start_st, gss_v)
+            for final_st in self.gss.pop_sets[gss_v]:
+                if self._add_result(start_st, final_st):
+                    res.append(final_st)
+        return res
+
+    def run(self) -> Iterator[tuple[int, int]]:
+        rsm = self.rsm
+        state_count = rsm.state_count
+        node_count = len(self.graph_index)
+        graph_index = self.graph_index
+        terminal_edges = rsm.terminal_edges
+        nonterminal_edges = rsm.nonterminal_edges
+        box_labels = rsm.box_labels
+        box_start_states = rsm.box_start_states
+        final_states = rsm.final_states
+        sppf = self.sppf
+        gss = self.gss
+        graph_sts = gss.graph_sts
+        init_gss_v = self.init_gss_v
+        queue = self.queue
+        push = self.push
+
+        while queue:
+            rest, rsm_st = divmod(queue.popleft(), state_count)
+            gss_v, graph_st = divmod(rest, node_count)
+            graph_edges = graph_index[graph_st]
+
+            for lbl, rsm_sts in terminal_edges[rsm_st].items():
+                for next_graph_st in graph_edges.get(lbl, ()):
+                    for next_rsm_st in rsm_sts:
+                        push(next_rsm_st, next_graph_st, gss_v)
+                        if sppf is not None:
+                            sppf.add_packed(
+                                next_rsm_st,
+                                graph_sts[gss_v],
+                                next_graph_st,
+                                (rsm_st, graph_st, lbl, None),
+                            )
+
+            for box, next_rsm_st in nonterminal_edges[rsm_st]:
+                # graph edges may carry nonterminal labels too, as in the tensor engine
+                lbl = box_labels[box]
+                for next_graph_st in graph_edges.get(lbl, ()):
+                    push(next_rsm_st, next_graph_st, gss_v)
+                    if sppf is not None:
+                        sppf.add_packed(
+                            next_rsm_st,
+                            graph_sts[gss_v],
+                            next_graph_st,
+                            (rsm_st, graph_st, lbl, None),
+                        )
+
+                for rsm_start_st in box_start_states[box]:
+                    new_gss_v, created = gss.get_or_add_vertex(rsm_start_st, graph_st)
+                    # with an SPPF the pops of a known edge are still recorded for
+                    # this caller, pushes are deduplicated anyway
+                    if not gss.add_edge(new_gss_v, next_rsm_st, gss_v) and sppf is None:
+                        continue
+                    if created:
+                        push(rsm_start_st, graph_st, new_gss_v)
+                    if sppf is not None:
+                        sppf.add_caller(new_gss_v, next_rsm_st, gss_v, rsm_st)
+                    for popped_graph_st in gss.pop_sets[new_gss_v]:
+                        push(next_rsm_st, popped_graph_st, gss_v)
+                        if sppf is not None:
+                            sppf.add_packed(
+                                next_rsm_st,
+                                graph_sts[gss_v],
+                                popped_graph_st,
+                                (rsm_st, graph_st, None, box),
+                            )
+
+            if not final_states >> rsm_st & 1:
+                continue
+            if sppf is not None:
+                box = int(rsm.box_of_states[rsm_st])
+                sppf.add_completion(box, graph_sts[gss_v], graph_st, rsm_st)
+            if not gss.add_pop(gss_v, graph_st):
+                continue
+            answered = False
+            for return_rsm_st, gss_vs in gss.edges[gss_v].items():
+                for return_gss_v in gss_vs:
+                    if return_gss_v == init_gss_v:
+                        answered = True
+                        continue
+                    push(return_rsm_st, graph_st, return_gss_v)
+                    if sppf is not None:
+                        callers = sppf.callers[(gss_v, return_rsm_st, return_gss_v)]
+                        for from_st in callers:
+                            sppf.add_packed(
+                                return_rsm_st,
+                                graph_sts[return_gss_v],
+                                graph_st,
+                                (from_st, graph_sts[gss_v], None, box),
+                            )
+            # answers are yielded only after the descriptor is fully processed,
+            # so a caller may stop iterating at any point and resume later
+            if answered and self._add_result(graph_sts[gss_v], graph_st):
+                yield graph_sts[gss_v], graph_st
+
+
+def gll_closure(
+    rsm: CompiledRSM,
+    graph_index: GraphIndex,
+    start_sts: list[int],
+    stats: Optional[GLLStats] = None,
+    sppf: Optional[SPPF] = None,
+) -> set[tuple[int, int]]:
+    started = time.perf_counter()
+    state = GLLState(rsm, graph_index, sppf)
+    for start_st in start_sts:
+        state.add_source(start_st)
+    res = set(state.run())
+    if stats is not None:
+        stats.descriptors += len(state.seen)
+        stats.elapsed += time.perf_counter() - started
+    return res
+
+
+# read-only query data of a worker process, set once by the pool initializer
+_worker_query: Optional[tuple[CompiledRSM, GraphIndex]] = None
+
+
+def _init_gll_worker(rsm: CompiledRSM, graph_index: GraphIndex):
+    global _worker_query
+    _worker_query = (rsm, graph_index)
+
+
+def _gll_shard(start_sts: list[int]) -> tuple[set[tuple[int, int]], int]:
+    shard_stats = GLLStats()
+    res = gll_closure(*_worker_query, start_sts, shard_stats)
+    return res, shard_stats.descriptors
+
+
+def parallel_gll_closure(
+    rsm: CompiledRSM,
+    graph_index: GraphIndex,
+    start_sts: list[int],
+    workers: int,
+    stats: Optional[GLLStats] = None,
+) -> set[tuple[int, int]]:
+    started = time.perf_counter()
+    # shards repeat the parts of the GSS they share, so there are only a few
+    # per worker: enough for an idle worker to pick up the rest of the work
+    # when some start vertices reach most of a scale-free graph
+    shard_size = max(1, len(start_sts) // (workers * 2))
+    shards = [
+        start_sts[i : i + shard_size] for i in range(0, len(start_sts), shard_size)
+    ]
     res = set()
-    if conf.rsm_st.st in rsm.get_box(conf.rsm_st.nonterm).final_states:
-        if gss.nodes[conf.gss_v][POP_SET] is None:
-            gss.nodes[conf.gss_v][POP_SET] = set()
-        gss.nodes[conf.gss_v][POP_SET].add(conf.graph_st)
-
-        gss_edges: dict[RSMSt, Set[GSSV]] = get_graph_node_edges(gss, conf.gss_v)
-        for lbl in gss_edges.keys():
-            for gss_v in gss_edges[lbl]:
-                if gss_v == init_gss_v:
-                    res.add((conf.gss_v.graph_st, conf.graph_st))
-                    continue
-                new_configs.add(Config(lbl, conf.graph_st, gss_v))
-
-    return new_configs, res
+    descriptors = 0
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_gll_worker,
+        initargs=(rsm, graph_index),
+    ) as executor:
+        for shard_res, shard_descriptors in executor.map(_gll_shard, shards):
+            res |= shard_res
+            descriptors += shard_descriptors
+    if stats is not None:
+        stats.descriptors += descriptors
+        stats.elapsed += time.perf_counter() - started
+    return res
 
 
 def gll_based_cfpq(
     rsm: RecursiveAutomaton,
-    graph: nx.DiGraph,
+    graph: nx.DiGraph | LabeledGraphIndex,
     start_nodes: Set[int] = None,
     final_nodes: Set[int] = None,
+    stats: Optional[GLLStats] = None,
+    workers: int = 1,
+    sppf: Optional[SPPF] = None,
 ) -> Set[tuple[int, int]]:
+    labeled_graph_index = as_labeled_graph_index(graph)
+    nodes = labeled_graph_index.nodes
+    index_of_nodes = labeled_graph_index.index_of_nodes
     if not start_nodes:
-        start_nodes = set(graph.nodes)
+        start_nodes = set(nodes)
     if not final_nodes:
-        final_nodes = set(graph.nodes)
-
-    queue: Set[Config] = set()
-    processed_config: Set[Config] = set()
-    GSS = nx.MultiDiGraph()
-    init_gss_v = GSSV(RSMSt(Symbol("$"), State(0)), -1)
-
-    for rsm_start in rsm.get_box(rsm.initial_label).start_state:
-        for graph_st in start_nodes:
-            rsm_st = RSMSt(rsm.initial_label, rsm_start)
-            gss_v = GSSV(rsm_st, graph_st)
-
-            GSS.add_node(gss_v, pop_set=None)
-            GSS.add_edge(gss_v, init_gss_v, label=rsm_st)
-            config = Config(rsm_st, graph_st, gss_v)
-            queue.add(config)
-
-    res = set()
-    while queue:
-        config = queue.pop()
-        if config in processed_config:
-            continue
-
-        processed_config.add(config)
-        new_configs, new_res = get_new_configs(config, GSS, graph, rsm, init_gss_v)
-        queue |= new_configs
-        res |= new_res
-
+        final_nodes = set(nodes)
+
+    compiled_rsm = compile_rsm(rsm)
+    graph_index = get_graph_index(labeled_graph_index)
+    start_sts = [index_of_nodes[node] for node in start_nodes if node in index_of_nodes]
+    if sppf is not None:
+        sppf.nodes = list(nodes)
+    # derivations are recorded by the sequential closure only
+    if workers > 1 and len(start_sts) > 1 and sppf is None:
+        res = parallel_gll_closure(compiled_rsm, graph_index, start_sts, workers, stats)
+    else:
+        res = gll_closure(compiled_rsm, graph_index, start_sts, stats, sppf)
     return {
-        (start_st, final_st)
+        (nodes[start_st], nodes[final_st])
         for start_st, final_st in res
-        if start_st in start_nodes and final_st in final_nodes
+        if nodes[final_st] in final_nodes
     }
+
+
+class GLLQuery:
+    def __init__(self, rsm: RecursiveAutomaton, graph: nx.DiGraph | LabeledGraphIndex):
+        labeled_graph_index = as_labeled_graph_index(graph)
+        self.nodes = labeled_graph_index.nodes
+        self.index_of_nodes = labeled_graph_index.index_of_nodes
+        self.state = GLLState(compile_rsm(rsm), get_graph_index(labeled_graph_index))
+
+    def reachable_from(self, node: Any) -> Iterator[Any]:
+        start_st = self.index_of_nodes.get(node)
+        if start_st is None:
+            return
+        state = self.state
+        yielded = set(state.results.get(start_st, ()))
+        for final_st in list(yielded):
+            yield self.nodes[final_st]
+        for final_st in state.add_source(start_st):
+            yielded.add(final_st)
+            yield self.nodes[final_st]
+        for found_st, final_st in state.run():
+            if found_st == start_st:
+                yielded.add(final_st)
+                yield self.nodes[final_st]
+        # answers found while another generator was driving the worklist
+        for final_st in list(state.results.get(start_st, set()) - yielded):
+            yield self.nodes[final_st]
@@ -0,0 +1,240 @@
+from collections import OrderedDict
+import os
+from pathlib import Path
+import tempfile
+from typing import Optional
+import numpy as np
+from pyformlang.cfg import CFG, Variable
+import networkx as nx
+from scipy.sparse import csr_matrix
+
+from project.graph_index import LabeledGraphIndex, as_labeled_graph_index
+from project.task6 import get_normalized_grammar
+from project.task7 import iter_adjacency_matrices, schedule_productions
+
+TileKey = tuple[int, int, int]
+
+
+def _tile_nbytes(tile: csr_matrix) -> int:
+    return tile.data.nbytes + tile.indices.nbytes + tile.indptr.nbytes
+
+
+class TileCache:
+    def __init__(self, directory: str | Path, memory_budget: int):
+        self.directory = Path(directory)
+        self.memory_budget = memory_budget
+        self.used_memory = 0
+        self._tiles: OrderedDict[TileKey, csr_matrix] = OrderedDict()
+        self._dirty: set[TileKey] = set()
+
+    def _paths_of(self, key: TileKey) -> tuple[Path, Path]:
+        matrix_id, i, j = key
+        prefix = self.directory / f"{matrix_id}" / f"{i}_{j}"
+        return prefix.with_suffix(".indptr.npy"), prefix.with_suffix(".indices.npy")
+
+    def _write(self, key: TileKey, tile: csr_matrix):
+        indptr_path, indices_path = self._paths_of(key)
+        indptr_path.parent.mkdir(parents=True, exist_ok=True)
+        # replace instead of overwriting so tiles still mapped from the old
+        # files stay valid
+        for path, array in ((indptr_path, tile.indptr), (indices_path, tile.indices)):
+            tmp_path = path.with_suffix(".tmp.npy")
+            np.save(tmp_path, array)
+            os.replace(tmp_path, path)
+
+    def _read(self, key: TileKey, tile_size: int) -> csr_matrix:
+        indptr_path, indices_path = self._paths_of(key)
+        indptr = np.load(indptr_path, mmap_mode="r")
+        indices = np.load(indices_path, mmap_mode="r")
+        return csr_matrix(
+            (np.ones(len(indices), dtype=np.bool_), indices, indptr),
+            shape=(tile_size, tile_size),
+        )
+
+    def _evict(self):
+        while self.used_memory > self.memory_budget and len(self._tiles) > 1:
+            key, tile = self._tiles.popitem(last=False)
+            if key in self._dirty:
+                self._write(key, tile)
+                self._dirty.discard(key)
+            self.used_memory -= _tile_nbytes(tile)
+
+    def get(self, key: TileKey, tile_size: int) -> csr_matrix:
+        tile = self._tiles.get(key)
+        if tile is not None:
+            self._tiles.move_to_end(key)
+            return tile
+        tile = self._read(key, tile_size)
+        self._tiles[key] = tile
+        self.used_memory += _tile_nbytes(tile)
+        self._evict()
+        return tile
+
+    def put(self, key: TileKey, tile: csr_matrix):
+        old_tile = self._tiles.pop(key, None)
+        if old_tile is not None:
+            self.used_memory -= _tile_nbytes(old_tile)
+        self._tiles[key] = tile
+        self._dirty.add(key)
+        self.used_memory += _tile_nbytes(tile)
+        self._evict()
+
+
+class TiledBoolMatrix:
+    def __init__(self, matrix_id: int, n: int, tile_size: int, cache: TileCache):
+        self.matrix_id = matrix_id
+        self.n = n
+        self.tile_size = tile_size
+        self.tiles_per_side = max(1, -(-n // tile_size))
+        self.cache = cache
+        self.nonempty: set[tuple[int, int]] = set()
+        # column indexes of the nonempty tiles of each tile row, and row
+        # indexes of the nonempty tiles of each tile column
+        self.row_tiles: dict[int, set[int]] = {}
+        self.column_tiles: dict[int, set[int]] = {}
+
+    def tile(self, i: int, j: int) -> Optional[csr_matrix]:
+        if (i, j) not in self.nonempty:
+            return None
+        return self.cache.get((self.matrix_id, i, j), self.tile_size)
+
+    def add_to_tile(self, i: int, j: int, tile: csr_matrix) -> bool:
+        old_tile = self.tile(i, j)
+        if old_tile is not None:
+            if (tile > old_tile).nnz == 0:
+                return False
+            tile = old_tile + tile
+        elif tile.nnz == 0:
+            return False
+        tile.sort_indices()
+        self.nonempty.add((i, j))
+        self.row_tiles.setdefault(i, set()).add(j)
+        self.column_tiles.setdefault(j, set()).add(i)
+        self.cache.put((self.matrix_id, i, j), tile)
+        return True
+
+    def load(self, matrix: csr_matrix):
+        size = self.tile_size
+        for i in range(self.tiles_per_side):
+            rows = matrix[i * size : (i + 1) * size]
+            tile_columns = np.unique(rows.indices // size)
+            if len(tile_columns) == 0:
+                continue
+            rows = rows.tocsc()
+            for j in tile_columns.tolist():
+                tile = rows[:, j * size : (j + 1) * size].tocsr()
+                tile.resize((size, size))
+                self.add_to_tile(i, j, tile)
+
+
+def _product_terms(
+    left: TiledBoolMatrix,
+    right: TiledBoolMatrix,
+    left_changed: Optional[set[tuple[int, int]]],
+    right_changed: Optional[set[tuple[int, int]]],
+) -> dict[tuple[int, int], set[int]]:
+    # only pairs of nonempty tiles with at least one changed side are
+    # visited, None stands for the first round where every tile is new
+    terms: dict[tuple[int, int], set[int]] = {}
+    for i, k in left.nonempty if left_changed is None else left_changed:
+        for j in right.row_tiles.get(k, ()):
+            terms.setdefault((i, j), set()).add(k)
+    if left_changed is not None:
+        for k, j in right_changed:
+            for i in left.column_tiles.get(k, ()):
+                terms.setdefault((i, j), set()).add(k)
+    return terms
+
+
+def _tiled_closure(
+    matrices: dict[Variable, TiledBoolMatrix],
+    nonterms_productions: dict[tuple[Variable, Variable], set[Variable]],
+):
+    # tiles that changed in the previous round, None for the first round
+    changed: Optional[dict[Variable, set[tuple[int, int]]]] = None
+    while changed is None or any(changed.values()):
+        new_changed: dict[Variable, set[tuple[int, int]]] = {
+            var: set() for var in matrices
+        }
+        for (B, C), heads in nonterms_productions.items():
+            left, right = matrices[B], matrices[C]
+            terms = _product_terms(
+                left,
+                right,
+                None if changed is None else changed[B],
+                None if changed is None else changed[C],
+            )
+            for (i, j), ks in sorted(terms.items()):
+                ks = sorted(ks)
+                product = left.tile(i, ks[0]) @ right.tile(ks[0], j)
+                for k in ks[1:]:
+                    product = product + left.tile(i, k) @ right.tile(k, j)
+                for head in heads:
+                    if matrices[head].add_to_tile(i, j, product):
+                        new_changed[head].add((i, j))
+        changed = new_changed
+
+
+def tiled_matrix_based_cfpq(
+    cfg: CFG,
+    graph: nx.DiGraph | LabeledGraphIndex,
+    start_nodes: set[int] = None,
+    final_nodes: set[int] = None,
+    tile_size: int = 4096,
+    memory_budget: int = 256 * 2**20,
+    directory: Optional[str | Path] = None,
+) -> set[tuple[int, int]]:
+    normalized = get_normalized_grammar(cfg)
+    weak_normal_form = normalized.weak_normal_form
+    start_symbol = weak_normal_form.start_symbol
+    if start_symbol not in weak_normal_form.variables:
+        return set()
+
+    graph_index = as_labeled_graph_index(graph)
+    nodes = graph_index.nodes
+    index_of_nodes = graph_index.index_of_nodes
+    n = len(nodes)
+
+    with tempfile.TemporaryDirectory(dir=directory) as tiles_directory:
+        cache = TileCache(tiles_directory, memory_budget)
+        matrices = {}
+        # each matrix is tiled before the next one is built
+        for matrix_id, (var, matrix) in enumerate(
+            iter_adjacency_matrices(
+                normalized.tables, weak_normal_form.variables, graph_index
+            )
+        ):
+            matrices[var] = TiledBoolMatrix(matrix_id, n, tile_size, cache)
+            matrices[var].load(matrix)
+            del matrix
+
+        for productions in schedule_productions(normalized.tables.nonterms_productions):
+            _tiled_closure(matrices, productions)
+
+        start_indexes = sorted(
+            index_of_nodes[node]
+            for node in (start_nodes or nodes)
+            if node in index_of_nodes
+        )
+        final_mask = np.zeros(n, dtype=np.bool_)
+        final_mask[
+            [
+                index_of_nodes[node]
+                for node in (final_nodes or nodes)
+                if node in index_of_nodes
+            ]
+        ] = True
+
+        res = set()
+        result = matrices[start_symbol]
+        for start_index in start_indexes:
+            i, row = divmod(start_index, tile_size)
+            for j in range(result.tiles_per_side):
+                tile = result.tile(i, j)
+                if tile is None:
+                    continue
+                columns = tile.indices[tile.indptr[row] : tile.indptr[row + 1]]
+                for column in columns + j * tile_size:
+                    if column < n and final_mask[column]:
+                        res.add((nodes[start_index], nodes[column]))
+        return res
@@ -0,0 +1,41 @@
+import random
+import cfpq_data
+import networkx as nx
+import pytest
+
+GRAMMARS = [
+    "S -> a S b | a b",
+    "S -> a S b S | $",
+    "S -> S S | a | b c",
+    "S -> A B\nA -> a A | $\nB -> b B | b",
+    "S -> A S | d\nA -> a B | c\nB -> A b | b",
+    "S -> a\nS -> B\nB -> d",
+    "S -> a b\nS -> S",
+]
+
+
+@pytest.fixture(params=GRAMMARS)
+def grammar_text(request) -> str:
+    return request.param
+
+
+@pytest.fixture(params=range(4))
+def graph(request) -> nx.MultiDiGraph:
+    seed = request.param
+    random.seed(seed)
+    if seed % 2:
+        return cfpq_data.graphs.labeled_scale_free_graph(
+            random.randint(1, 20), labels=["a", "b", "c", "d"]
+        )
+    return cfpq_data.graphs.labeled_binomial_graph(
+        n=random.randint(1, 20), p=0.3, labels=["a", "b", "c", "d"]
+    )
+
+
+@pytest.fixture
+def start_and_final(graph: nx.MultiDiGraph) -> tuple[set[int], set[int]]:
+    nodes = list(graph.nodes)
+    return (
+        set(random.sample(nodes, k=random.randint(1, len(nodes)))),
+        set(random.sample(nodes, k=random.randint(1, len(nodes)))),
+    )
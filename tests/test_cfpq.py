@@ -0,0 +1,89 @@
+import cfpq_data
+import networkx as nx
+from pyformlang.cfg import CFG
+import pytest
+
+from project.cfpq import ENGINES, CFPQDecision, choose_engine, cfpq, rsm_to_cfg
+from project.task7 import matrix_based_cfpq
+from project.task8 import ebnf_to_rsm
+
+EBNF_GRAMMARS = [
+    ("S -> a* S b | c", "S -> A S b | c\nA -> a A | $"),
+    ("S -> (a | b)* c", "S -> A c\nA -> a A | b A | $"),
+]
+
+
+@pytest.mark.parametrize("engine", ["auto", *ENGINES])
+def test_engines_agree_on_cfg_and_text(
+    engine: str, grammar_text: str, graph, start_and_final
+):
+    start_nodes, final_nodes = start_and_final
+    cfg = CFG.from_text(grammar_text)
+
+    expected = matrix_based_cfpq(cfg, graph, start_nodes, final_nodes)
+    assert cfpq(cfg, graph, start_nodes, final_nodes, engine) == expected
+    assert cfpq(grammar_text, graph, start_nodes, final_nodes, engine) == expected
+
+
+@pytest.mark.parametrize("engine", ["auto", *ENGINES])
+@pytest.mark.parametrize("ebnf, grammar", EBNF_GRAMMARS)
+def test_engines_agree_on_ebnf_and_rsm(
+    engine: str, ebnf: str, grammar: str, graph, start_and_final
+):
+    start_nodes, final_nodes = start_and_final
+
+    expected = matrix_based_cfpq(
+        CFG.from_text(grammar), graph, start_nodes, final_nodes
+    )
+    assert (
+        cfpq(ebnf, graph, start_nodes, final_nodes, engine, grammar_format="ebnf")
+        == expected
+    )
+    assert cfpq(ebnf_to_rsm(ebnf), graph, start_nodes, final_nodes, engine) == expected
+
+
+@pytest.mark.parametrize("engine", ["auto", *ENGINES])
+def test_cfg_text_with_parenthesis_terminals(engine: str):
+    graph = nx.MultiDiGraph()
+    for u, label in enumerate("()()"):
+        graph.add_edge(u, u + 1, label=label)
+
+    expected = {(0, 0), (0, 2), (0, 4)}
+    assert cfpq("S -> ( S ) S | $", graph, {0}, None, engine) == expected
+
+
+@pytest.mark.parametrize("engine", ["auto", *ENGINES])
+@pytest.mark.parametrize("grammar", [CFG.from_text("A -> a"), CFG(), "A -> a"])
+def test_start_symbol_without_productions(engine: str, grammar, graph):
+    assert cfpq(grammar, graph, engine=engine) == set()
+
+
+def test_rsm_to_cfg_preserves_language():
+    cfg = rsm_to_cfg(ebnf_to_rsm("S -> a* S b | c"))
+
+    assert cfg.contains("cb")
+    assert cfg.contains("aacbb")
+    assert not cfg.contains("ab")
+
+
+def test_choose_engine_exposes_decision():
+    graph = cfpq_data.graphs.labeled_two_cycles_graph(50, 50, labels=("a", "b"))
+    decision = CFPQDecision()
+
+    cfpq("S -> a S b | a b", graph, {0}, engine="auto", decision=decision)
+
+    assert decision.engine == "gll"
+    assert decision.node_count == graph.number_of_nodes()
+    assert decision.start_count == 1
+    assert choose_engine("S -> a S b | a b", graph).engine == "matrix"
+    small_graph = cfpq_data.graphs.labeled_two_cycles_graph(3, 3, labels=("a", "b"))
+    assert choose_engine("S -> a b", small_graph).engine == "hellings"
+
+
+def test_unknown_engine_and_grammar_format():
+    graph = cfpq_data.graphs.labeled_two_cycles_graph(3, 3, labels=("a", "b"))
+
+    with pytest.raises(ValueError):
+        cfpq("S -> a b", graph, engine="cyk")
+    with pytest.raises(ValueError):
+        cfpq("S -> a b", graph, grammar_format="bnf")
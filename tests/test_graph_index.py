@@ -0,0 +1,76 @@
+import cfpq_data
+import networkx as nx
+from pyformlang.cfg import CFG
+import pytest
+
+from project.cfpq import ENGINES, cfpq
+from project.graph_index import LabeledGraphIndex
+from project.task3 import AdjacencyMatrixFA, tensor_based_rpq
+from project.task4 import ms_bfs_based_rpq
+
+
+def test_index_of_graph():
+    graph = nx.MultiDiGraph()
+    graph.add_nodes_from(["x", "y", "z", "isolated"])
+    graph.add_edge("x", "y", label="a")
+    graph.add_edge("x", "y", label="a")
+    graph.add_edge("x", "z", label="b")
+    graph.add_edge("z", "x", label="a")
+
+    index = LabeledGraphIndex.from_graph(graph)
+
+    assert index.nodes == ("x", "y", "z", "isolated")
+    assert index.index_of_nodes["z"] == 2
+    # the counts keep the parallel x -> y edges, the matrices merge them
+    assert dict(index.edge_counts) == {"a": 3, "b": 1}
+    assert index.edge_count == 4
+    assert index.out_degrees.tolist() == [3, 0, 1, 0]
+    assert index.in_degrees.tolist() == [1, 2, 1, 0]
+    assert index.csr["a"].nnz == 2
+    assert (index.csr["a"] != index.csc["a"]).nnz == 0
+    assert sorted(index.edges()) == [("x", "y", "a"), ("x", "z", "b"), ("z", "x", "a")]
+
+
+def test_index_is_read_only():
+    graph = cfpq_data.graphs.labeled_two_cycles_graph(2, 2, labels=("a", "b"))
+    index = LabeledGraphIndex.from_graph(graph)
+
+    with pytest.raises(TypeError):
+        index.csr["c"] = index.csr["a"]
+    with pytest.raises(ValueError):
+        index.out_degrees[0] = 5
+    with pytest.raises(ValueError):
+        index.csr["a"].data[0] = False
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_cfpq_engines_accept_index(engine: str):
+    graph = cfpq_data.graphs.labeled_two_cycles_graph(4, 3, labels=("a", "b"))
+    grammar = CFG.from_text("S -> a S b | a b")
+    index = LabeledGraphIndex.from_graph(graph)
+
+    expected = cfpq(grammar, graph, {0, 1}, None, engine)
+    assert cfpq(grammar, index, {0, 1}, None, engine) == expected
+
+
+@pytest.mark.parametrize("rpq", [tensor_based_rpq, ms_bfs_based_rpq])
+def test_rpq_accepts_index(rpq):
+    graph = cfpq_data.graphs.labeled_two_cycles_graph(4, 3, labels=("a", "b"))
+    index = LabeledGraphIndex.from_graph(graph)
+
+    expected = rpq("a* b", graph, {0, 1}, {0, 5})
+    assert rpq("a* b", index, {0, 1}, {0, 5}) == expected
+
+
+def test_queries_do_not_change_shared_index():
+    graph = nx.MultiDiGraph()
+    graph.add_edge(0, 1, label="a")
+    graph.add_edge(1, 2, label="a")
+    index = LabeledGraphIndex.from_graph(graph)
+
+    assert not AdjacencyMatrixFA.from_graph_index(index, {0}, {2}).is_empty()
+    assert cfpq(CFG.from_text("S -> a"), index, None, None, "matrix") == {
+        (0, 1),
+        (1, 2),
+    }
+    assert index.csr["a"].nnz == index.csc["a"].nnz == index.edge_counts["a"] == 2
@@ -1,11 +1,17 @@
 from typing import Any, Iterable, Tuple
+import cfpq_data
 import networkx as nx
 from networkx.utils.misc import graphs_equal
 import pytest
 
+from project.graph_index import LabeledGraphIndex
 from project.task1 import (
+    GRAPH_STATISTICS_CACHE,
+    DatasetCache,
     GraphInfo,
+    get_graph_info,
     get_graph_info_via_name,
+    load_graph_csv,
     save_labeled_two_cycles_graph,
 )
 
@@ -19,6 +25,149 @@ def test_get_graph_info_via_name(graph_name: str, graph_info_expected: GraphInfo
     assert graph_info == graph_info_expected
 
 
+@pytest.mark.parametrize("chunk_size", [16, 2**20])
+@pytest.mark.parametrize(
+    "text",
+    [
+        "0 1 a\n1 2 b\n2 0 a\n0 1 a\n7 7 c\n3 1 b\n",
+        "0 1 1\n1 2 2\n2 0 1\n0 1 01\n",
+        "0 1 1\n1 2 a\n2 0 1\n",
+    ],
+)
+def test_load_graph_csv_matches_cfpq_data(tmp_path, chunk_size: int, text: str):
+    path = tmp_path / "graph.csv"
+    path.write_text(text)
+
+    loaded = load_graph_csv(path, chunk_size=chunk_size)
+    graph = cfpq_data.graph_from_csv(path)
+
+    assert loaded.info == GraphInfo(
+        node_count=len(graph),
+        edge_count=graph.number_of_edges(),
+        edge_labels=cfpq_data.get_sorted_labels(graph),
+    )
+    expected_index = LabeledGraphIndex.from_graph(graph)
+    assert sorted(loaded.graph_index.edges()) == sorted(expected_index.edges())
+
+
+def test_dataset_cache_works_offline_after_first_load(tmp_path, monkeypatch):
+    source = tmp_path / "source.csv"
+    source.write_text("0 1 a\n1 2 b\n2 0 a\nx 0 b\n")
+    downloads = []
+
+    def download(name: str):
+        downloads.append(name)
+        return source
+
+    monkeypatch.setattr(cfpq_data, "download", download)
+    cache_dir = tmp_path / "cache"
+
+    expected = load_graph_csv(source)
+    assert DatasetCache(cache_dir).load("toy").info == expected.info
+    assert downloads == ["toy"]
+
+    offline_cache = DatasetCache(cache_dir, offline=True)
+    loaded = offline_cache.load("toy")
+    assert loaded.info == expected.info
+    assert loaded.graph_index.nodes == expected.graph_index.nodes
+    assert set(loaded.graph_index.edges()) == set(expected.graph_index.edges())
+    assert downloads == ["toy"]
+
+    # a damaged binary is rebuilt from the intact cached CSV
+    (npz,) = (cache_dir / "toy").glob("*.npz")
+    npz.write_bytes(b"garbage")
+    assert offline_cache.load("toy").info == expected.info
+
+    # a cached CSV changed since it was stored can not be fixed offline
+    npz.unlink()
+    (cache_dir / "toy" / "graph.csv").write_text("0 1 a\n")
+    with pytest.raises(FileNotFoundError):
+        offline_cache.load("toy")
+    with pytest.raises(FileNotFoundError):
+        offline_cache.load("unknown")
+
+    assert DatasetCache(cache_dir).load("toy").info == expected.info
+    assert downloads == ["toy", "toy"]
+
+
+def degree_histogram(degrees) -> list[int]:
+    histogram = [0] * (max(degree for _, degree in degrees) + 1)
+    for _, degree in degrees:
+        histogram[degree] += 1
+    return histogram
+
+
+def test_detailed_graph_info_matches_networkx():
+    graph = cfpq_data.labeled_two_cycles_graph(4, 2, labels=("a", "b"))
+    graph.add_edge(9, 9, label="c")
+    graph.add_edge(0, 9, label="a")
+
+    GRAPH_STATISTICS_CACHE.clear()
+    info = get_graph_info(graph, detailed=True)
+    statistics = info.statistics
+    assert get_graph_info(graph) == GraphInfo(
+        node_count=info.node_count,
+        edge_count=info.edge_count,
+        edge_labels=info.edge_labels,
+    )
+
+    n = graph.number_of_nodes()
+    label_edge_counts = {}
+    for _, _, label in graph.edges(data="label"):
+        label_edge_counts[label] = label_edge_counts.get(label, 0) + 1
+    sccs = list(nx.strongly_connected_components(graph))
+    assert statistics.label_edge_counts == label_edge_counts
+    label_pairs = {}
+    for u, v, label in graph.edges(data="label"):
+        label_pairs.setdefault(label, set()).add((u, v))
+    assert statistics.label_densities == {
+        label: len(pairs) / n**2 for label, pairs in label_pairs.items()
+    }
+    assert statistics.out_degree_histogram == degree_histogram(graph.out_degree)
+    assert statistics.in_degree_histogram == degree_histogram(graph.in_degree)
+    assert statistics.self_loop_count == nx.number_of_selfloops(graph)
+    assert statistics.scc_count == len(sccs)
+    assert statistics.largest_scc_size == max(map(len, sccs))
+
+    # an equal graph reuses the cached statistics
+    index = LabeledGraphIndex.from_graph(graph.copy())
+    assert get_graph_info(index, detailed=True).statistics is statistics
+    assert len(GRAPH_STATISTICS_CACHE) == 1
+
+
+def test_graph_info_counts_parallel_edges(tmp_path):
+    graph = nx.MultiDiGraph()
+    for _ in range(3):
+        graph.add_edge(0, 1, label="a")
+    graph.add_edge(1, 2, label="b")
+    graph.add_edge(2, 0, label="b")
+    graph.add_edge(2, 2, label="c")
+    graph.add_edge(2, 2, label="c")
+    path = tmp_path / "graph.csv"
+    path.write_text(
+        "".join(f"{u} {v} {label}\n" for u, v, label in graph.edges(data="label"))
+    )
+
+    GRAPH_STATISTICS_CACHE.clear()
+    info = get_graph_info(graph, detailed=True)
+    index = LabeledGraphIndex.from_graph(graph)
+    assert info.edge_count == 7
+    assert info.edge_labels == ["a", "b", "c"]
+    assert get_graph_info(index, detailed=True) == info
+    assert load_graph_csv(path).info == get_graph_info(graph)
+
+    statistics = info.statistics
+    assert statistics.label_edge_counts == {"a": 3, "b": 2, "c": 2}
+    assert statistics.label_densities == {"a": 1 / 9, "b": 2 / 9, "c": 1 / 9}
+    assert statistics.out_degree_histogram == degree_histogram(graph.out_degree)
+    assert statistics.in_degree_histogram == degree_histogram(graph.in_degree)
+    assert statistics.self_loop_count == nx.number_of_selfloops(graph)
+
+    # the same edges without the parallel ones have other statistics
+    simple = LabeledGraphIndex.from_graph(nx.MultiDiGraph(nx.DiGraph(graph)))
+    assert get_graph_info(simple, detailed=True).statistics != statistics
+
+
 @pytest.mark.parametrize(
     "n,m,labels,path_to_expected_LTCG",
     [(5, 2, ("a", "b"), "tests/static/task1/5_2_ab.dot")],
@@ -0,0 +1,142 @@
+import networkx as nx
+from pyformlang.cfg import CFG, Production, Terminal, Variable
+
+from project.task6 import (
+    NORMALIZATION_HASH,
+    WeakNormalFormCache,
+    cfg_fingerprint,
+    cfg_to_weak_normal_form,
+    compact_hellings_based_cfpq,
+    get_normalized_grammar,
+    hellings_based_cfpq,
+    optimize_grammar,
+)
+from project.task7 import matrix_based_cfpq
+
+
+def test_compact_hellings_equals_hellings(grammar_text: str, graph, start_and_final):
+    start_nodes, final_nodes = start_and_final
+    cfg = CFG.from_text(grammar_text)
+
+    expected = hellings_based_cfpq(cfg, graph, start_nodes, final_nodes)
+    assert compact_hellings_based_cfpq(cfg, graph, start_nodes, final_nodes) == expected
+    assert compact_hellings_based_cfpq(cfg, graph) == hellings_based_cfpq(cfg, graph)
+
+
+def test_fingerprint_ignores_production_order():
+    assert cfg_fingerprint(CFG.from_text("S -> a S\nS -> b")) == cfg_fingerprint(
+        CFG.from_text("S -> b\nS -> a S")
+    )
+    assert cfg_fingerprint(CFG.from_text("S -> a")) != cfg_fingerprint(
+        CFG.from_text("S -> b")
+    )
+
+
+def test_fingerprint_distinguishes_value_types():
+    def grammar(var_value, term_value) -> CFG:
+        start = Variable("S")
+        return CFG(
+            start_symbol=start,
+            productions={
+                Production(start, [Variable(var_value)]),
+                Production(Variable(var_value), [Terminal(term_value)]),
+            },
+        )
+
+    assert cfg_fingerprint(grammar(1, "1")) != cfg_fingerprint(grammar("1", "1"))
+    assert cfg_fingerprint(grammar("1", 1)) != cfg_fingerprint(grammar("1", "1"))
+
+    cfg = CFG(
+        start_symbol=Variable("S"),
+        productions={Production(Variable("S"), [Terminal(1)])},
+    )
+    graph = nx.MultiDiGraph()
+    graph.add_edge(0, 1, label=1)
+    assert matrix_based_cfpq(cfg, graph) == {(0, 1)}
+
+    cfg = CFG(
+        start_symbol=Variable("S"),
+        productions={Production(Variable("S"), [Terminal("1")])},
+    )
+    graph = nx.MultiDiGraph()
+    graph.add_edge(0, 1, label="1")
+    assert matrix_based_cfpq(cfg, graph) == {(0, 1)}
+
+
+def test_weak_normal_form_cache_evicts_least_recently_used():
+    cache = WeakNormalFormCache(maxsize=2)
+    first = cache.get(CFG.from_text("S -> a S b | a b"))
+    cache.get(CFG.from_text("S -> a S b S | $"))
+    assert cache.get(CFG.from_text("S -> a S b | a b")) is first
+
+    cache.get(CFG.from_text("S -> S S | a | b c"))
+    assert len(cache) == 2
+    assert cache.get(CFG.from_text("S -> a S b | a b")) is first
+
+
+def test_weak_normal_form_cache_persists_to_disk(tmp_path):
+    cfg = CFG.from_text("S -> a S b S | $")
+    stored = WeakNormalFormCache(cache_dir=tmp_path).get(cfg)
+    assert len(list(tmp_path.glob(f"*.{NORMALIZATION_HASH}.*.json"))) == 1
+
+    loaded = WeakNormalFormCache(cache_dir=tmp_path).get(cfg)
+    assert loaded is not stored
+    assert set(loaded.weak_normal_form.productions) == set(
+        stored.weak_normal_form.productions
+    )
+    assert loaded.tables == stored.tables
+    assert loaded.reduction == stored.reduction
+
+    # a damaged entry is normalized again instead of being trusted
+    (path,) = tmp_path.glob("*.json")
+    path.write_text('{"productions": [["variable"]]}')
+    recomputed = WeakNormalFormCache(cache_dir=tmp_path).get(cfg)
+    assert recomputed.tables == stored.tables
+
+
+def test_cfg_to_weak_normal_form_returns_a_copy():
+    cfg = CFG.from_text("S -> a S b | a b")
+    weak_normal_form = cfg_to_weak_normal_form(cfg)
+    weak_normal_form.productions.clear()
+
+    assert cfg_to_weak_normal_form(cfg).productions
+    assert get_normalized_grammar(cfg).weak_normal_form.productions
+
+
+def test_optimize_grammar_merges_equivalent_and_alias_variables():
+    cfg = CFG.from_text("S -> A B | B C\nA -> a\nB -> a\nC -> D\nD -> a\nE -> e")
+    optimized, reduction = optimize_grammar(cfg)
+
+    assert len(optimized.variables) == 2
+    assert reduction.variables_before == 6
+    assert reduction.removed_variables == 4
+    assert reduction.productions_after == len(optimized.productions)
+    assert optimized.contains("aa") and not optimized.contains("a")
+
+
+def test_normalized_grammar_merges_fresh_variables():
+    cfg = CFG.from_text("S -> a b | A b\nA -> a")
+    normalized = get_normalized_grammar(cfg)
+    weak_normal_form = normalized.weak_normal_form
+
+    # A and the fresh variable that to_normal_form adds for a are merged,
+    # which also makes S -> A b and S -> a b one production
+    assert normalized.reduction.removed_variables == 1
+    assert normalized.reduction.removed_productions == 2
+    assert len(weak_normal_form.variables) == 3
+    assert not any(
+        len(production.body) == 1 and isinstance(production.body[0], Variable)
+        for production in weak_normal_form.productions
+    )
+    assert weak_normal_form.contains("ab") and not weak_normal_form.contains("a")
+
+
+def test_normalized_grammar_keeps_language(grammar_text: str):
+    cfg = CFG.from_text(grammar_text)
+    normalized = get_normalized_grammar(cfg)
+
+    assert normalized.reduction.variables_after == len(
+        normalized.weak_normal_form.variables
+    )
+    for word in ["", "a", "ab", "aabb", "abab", "bc", "abb", "d"]:
+        assert normalized.weak_normal_form.contains(word) == cfg.contains(word)
@@ -0,0 +1,97 @@
+import random
+from pyformlang.cfg import CFG, Variable
+import pytest
+
+from project.graph_index import LabeledGraphIndex
+from project.task6 import get_normalized_grammar, hellings_based_cfpq
+from project.task7 import (
+    MatrixCFPQStats,
+    init_adjacency_matrices,
+    matrix_based_cfpq,
+    ms_matrix_based_cfpq,
+    schedule_productions,
+    semi_naive_closure,
+)
+
+
+def test_matrix_equals_hellings(grammar_text: str, graph, start_and_final):
+    start_nodes, final_nodes = start_and_final
+    cfg = CFG.from_text(grammar_text)
+
+    expected = hellings_based_cfpq(cfg, graph, start_nodes, final_nodes)
+    assert matrix_based_cfpq(cfg, graph, start_nodes, final_nodes) == expected
+
+
+def test_ms_matrix_equals_matrix(grammar_text: str, graph, start_and_final):
+    start_nodes, final_nodes = start_and_final
+    start_nodes = set(random.sample(sorted(start_nodes), k=min(3, len(start_nodes))))
+    cfg = CFG.from_text(grammar_text)
+
+    expected = matrix_based_cfpq(cfg, graph, start_nodes, final_nodes)
+    assert ms_matrix_based_cfpq(cfg, graph, start_nodes, final_nodes) == expected
+
+
+@pytest.mark.parametrize(
+    "grammar_text",
+    [
+        "S -> a S b | a b",
+        "S -> S S | a | b c",
+        "S -> A S | d\nA -> a B | c\nB -> A b | b",
+    ],
+)
+@pytest.mark.parametrize("graph", range(2), indirect=True)
+def test_parallel_matrix_equals_sequential(grammar_text: str, graph, start_and_final):
+    start_nodes, final_nodes = start_and_final
+    cfg = CFG.from_text(grammar_text)
+    sequential_stats, parallel_stats = MatrixCFPQStats(), MatrixCFPQStats()
+
+    expected = matrix_based_cfpq(
+        cfg, graph, start_nodes, final_nodes, stats=sequential_stats
+    )
+    actual = matrix_based_cfpq(
+        cfg, graph, start_nodes, final_nodes, workers=4, stats=parallel_stats
+    )
+    assert actual == expected
+    assert parallel_stats.products == sequential_stats.products
+    assert parallel_stats.rounds == sequential_stats.rounds > 0
+
+
+def test_schedule_productions_follows_nonterminal_sccs():
+    A, B, C, S = map(Variable, "ABCS")
+    nonterms_productions = {
+        (A, A): {B},
+        (B, B): {B, C},
+        (C, B): {S},
+        (S, A): {C},
+    }
+
+    # A feeds B, B feeds the mutually recursive C and S, A A is evaluated
+    # once between the components and B B also feeds C while closing B
+    assert schedule_productions(nonterms_productions) == [
+        {(A, A): {B}},
+        {(B, B): {B, C}},
+        {(C, B): {S}, (S, A): {C}},
+    ]
+
+
+def test_scheduled_closure_needs_no_more_products(graph):
+    cfg = CFG.from_text("S -> B S | B\nB -> C B | C\nC -> a b | a C b")
+    normalized = get_normalized_grammar(cfg)
+    scheduled_stats, unscheduled_stats = MatrixCFPQStats(), MatrixCFPQStats()
+
+    expected = matrix_based_cfpq(cfg, graph, stats=scheduled_stats)
+    adjacency_matrices = init_adjacency_matrices(
+        normalized.tables,
+        normalized.weak_normal_form.variables,
+        LabeledGraphIndex.from_graph(graph),
+    )
+    semi_naive_closure(
+        adjacency_matrices,
+        normalized.tables.nonterms_productions,
+        stats=unscheduled_stats,
+    )
+
+    start_matrix = adjacency_matrices[normalized.weak_normal_form.start_symbol]
+    assert start_matrix.nnz == len(expected)
+    assert len(schedule_productions(normalized.tables.nonterms_productions)) > 1
+    assert scheduled_stats.products <= unscheduled_stats.products
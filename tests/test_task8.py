@@ -0,0 +1,74 @@
+import random
+from pyformlang.cfg import CFG
+
+from project.task7 import matrix_based_cfpq
+from project.task8 import (
+    cfg_to_rsm,
+    compile_rsm,
+    ebnf_to_rsm,
+    ms_tensor_based_cfpq,
+    rsm_fingerprint,
+    tensor_based_cfpq,
+)
+
+
+def test_tensor_equals_matrix(grammar_text: str, graph, start_and_final):
+    start_nodes, final_nodes = start_and_final
+    cfg = CFG.from_text(grammar_text)
+
+    expected = matrix_based_cfpq(cfg, graph, start_nodes, final_nodes)
+    actual = tensor_based_cfpq(cfg_to_rsm(cfg), graph, start_nodes, final_nodes)
+    assert actual == expected
+
+
+def test_ms_tensor_equals_tensor(grammar_text: str, graph, start_and_final):
+    start_nodes, final_nodes = start_and_final
+    start_nodes = set(random.sample(sorted(start_nodes), k=min(3, len(start_nodes))))
+    rsm = cfg_to_rsm(CFG.from_text(grammar_text))
+
+    expected = tensor_based_cfpq(rsm, graph, start_nodes, final_nodes)
+    assert ms_tensor_based_cfpq(rsm, graph, start_nodes, final_nodes) == expected
+
+
+def test_compile_rsm_indexes_box_states():
+    rsm = ebnf_to_rsm("S -> a S b | $\nA -> c*")
+    compiled = compile_rsm(rsm)
+
+    assert compile_rsm(rsm) is compiled
+    assert compiled.state_count == sum(
+        len(box.dfa.states) for box in rsm.boxes.values()
+    )
+    assert sorted(compiled.index_of_states.values()) == list(
+        range(compiled.state_count)
+    )
+    for nonterminal, box in rsm.boxes.items():
+        assert compiled.start_masks[nonterminal].sum() == len(box.dfa.start_states)
+        assert compiled.final_masks[nonterminal].sum() == len(box.dfa.final_states)
+
+
+def test_compile_rsm_once_per_grammar():
+    cfg = CFG.from_text("S -> a S b S | $\nA -> c A | d")
+    compiled = compile_rsm(cfg_to_rsm(cfg))
+
+    assert compile_rsm(cfg_to_rsm(cfg)) is compiled
+    assert rsm_fingerprint(ebnf_to_rsm("S -> a S b | $")) == rsm_fingerprint(
+        ebnf_to_rsm("S -> a S b | $")
+    )
+    assert rsm_fingerprint(ebnf_to_rsm("S -> a S b | $")) != rsm_fingerprint(
+        ebnf_to_rsm("S -> a S c | $")
+    )
+
+
+def test_compile_rsm_builds_transition_tables():
+    rsm = ebnf_to_rsm("S -> a S b | $")
+    compiled = compile_rsm(rsm)
+
+    assert compiled.box_labels == ["S"]
+    (start,) = compiled.box_start_states[0]
+    assert compiled.final_states >> start & 1
+    (after_a,) = compiled.terminal_edges[start]["a"]
+    assert compiled.terminal_edges[start].keys() == {"a"}
+    ((box, after_s),) = compiled.nonterminal_edges[after_a]
+    assert box == 0
+    (final,) = compiled.terminal_edges[after_s]["b"]
+    assert compiled.final_states >> final & 1
@@ -0,0 +1,102 @@
+import random
+from pyformlang.cfg import CFG
+import pytest
+
+from project.task7 import matrix_based_cfpq
+from project.task8 import cfg_to_rsm
+from project.task9 import GLLQuery, GLLStats, GSS, SPPF, gll_based_cfpq
+
+
+def test_gll_equals_matrix(grammar_text: str, graph, start_and_final):
+    start_nodes, final_nodes = start_and_final
+    cfg = CFG.from_text(grammar_text)
+
+    expected = matrix_based_cfpq(cfg, graph, start_nodes, final_nodes)
+    assert gll_based_cfpq(cfg_to_rsm(cfg), graph, start_nodes, final_nodes) == expected
+
+
+def test_gss_deduplicates_vertices_edges_and_pops():
+    gss = GSS(node_count=10)
+    root, _ = gss.get_or_add_vertex(-1, 0)
+    vertex, created = gss.get_or_add_vertex(0, 1)
+    assert created
+    assert gss.get_or_add_vertex(0, 1) == (vertex, False)
+
+    assert gss.add_edge(vertex, 2, root)
+    assert not gss.add_edge(vertex, 2, root)
+    assert gss.edges[vertex] == {2: {root}}
+
+    assert gss.add_pop(vertex, 5)
+    assert not gss.add_pop(vertex, 5)
+    assert gss.pop_sets[vertex] == {5}
+
+
+@pytest.mark.parametrize("graph", [1], indirect=True)
+def test_gll_stats_count_descriptors(graph):
+    rsm = cfg_to_rsm(CFG.from_text("S -> S S | a | b c"))
+    stats = GLLStats()
+
+    gll_based_cfpq(rsm, graph, stats=stats)
+
+    assert stats.descriptors >= len(graph.nodes)
+    assert stats.elapsed > 0
+    assert stats.descriptors_per_second > 0
+
+
+@pytest.mark.parametrize(
+    "grammar_text", ["S -> a S b | a b", "S -> a S b S | $", "S -> S S | a | b c"]
+)
+@pytest.mark.parametrize("graph", range(2), indirect=True)
+def test_parallel_gll_equals_sequential(grammar_text: str, graph, start_and_final):
+    start_nodes, final_nodes = start_and_final
+    rsm = cfg_to_rsm(CFG.from_text(grammar_text))
+    sequential_stats = GLLStats()
+    parallel_stats = GLLStats()
+
+    expected = gll_based_cfpq(rsm, graph, start_nodes, final_nodes, sequential_stats)
+    actual = gll_based_cfpq(
+        rsm, graph, start_nodes, final_nodes, parallel_stats, workers=2
+    )
+
+    assert actual == expected
+    assert parallel_stats.descriptors >= sequential_stats.descriptors
+
+
+def test_sppf_paths_justify_answers(grammar_text: str, graph, start_and_final):
+    start_nodes, final_nodes = start_and_final
+    cfg = CFG.from_text(grammar_text)
+    rsm = cfg_to_rsm(cfg)
+    sppf = SPPF()
+
+    res = gll_based_cfpq(rsm, graph, start_nodes, final_nodes, sppf=sppf)
+
+    assert res == gll_based_cfpq(rsm, graph, start_nodes, final_nodes)
+    for start, final in res:
+        path = sppf.path(start, final)
+        assert path is not None
+        node = start
+        for from_nd, lbl, to_nd in path:
+            assert from_nd == node
+            assert lbl in {
+                edge_lbl
+                for _, v, edge_lbl in graph.out_edges(from_nd, data="label")
+                if v == to_nd
+            }
+            node = to_nd
+        assert node == final
+        assert cfg.contains([lbl for _, lbl, _ in path])
+
+
+def test_gll_query_reachable_from(grammar_text: str, graph, start_and_final):
+    rsm = cfg_to_rsm(CFG.from_text(grammar_text))
+    expected = gll_based_cfpq(rsm, graph)
+    query = GLLQuery(rsm, graph)
+
+    nodes = list(graph.nodes)
+    random.shuffle(nodes)
+    for node in nodes:
+        # stop early once to check that an interrupted query can be resumed
+        next(query.reachable_from(node), None)
+        finals = list(query.reachable_from(node))
+        assert len(finals) == len(set(finals))
+        assert set(finals) == {final for start, final in expected if start == node}
@@ -0,0 +1,42 @@
+import cfpq_data
+from pyformlang.cfg import CFG
+import pytest
+
+from project.task7 import matrix_based_cfpq
+from project.tiled_cfpq import tiled_matrix_based_cfpq
+
+
+@pytest.mark.parametrize("tile_size,memory_budget", [(4, 256), (7, 2**20), (64, 0)])
+def test_tiled_matrix_equals_matrix(
+    grammar_text: str,
+    graph,
+    start_and_final,
+    tile_size: int,
+    memory_budget: int,
+    tmp_path,
+):
+    start_nodes, final_nodes = start_and_final
+    cfg = CFG.from_text(grammar_text)
+
+    expected = matrix_based_cfpq(cfg, graph, start_nodes, final_nodes)
+    actual = tiled_matrix_based_cfpq(
+        cfg,
+        graph,
+        start_nodes,
+        final_nodes,
+        tile_size=tile_size,
+        memory_budget=memory_budget,
+        directory=tmp_path,
+    )
+    assert actual == expected
+
+
+def test_tiled_matrix_on_many_tiles(tmp_path):
+    graph = cfpq_data.graphs.labeled_two_cycles_graph(60, 45, labels=("a", "b"))
+    cfg = CFG.from_text("S -> a S b | a b")
+
+    expected = matrix_based_cfpq(cfg, graph)
+    actual = tiled_matrix_based_cfpq(
+        cfg, graph, tile_size=8, memory_budget=1024, directory=tmp_path
+    )
+    assert actual == expected